@@ -0,0 +1,106 @@
+import os
+import glob
+import io
+import contextlib
+import time as t
+
+# This is the batch runner for the v9 backend
+# It runs main() of CoE199_main_v9 on every recording of a directory or glob over a process pool, and writes one row per
+# recording with the heart rate, respiratory rate, the time of every stage and the error if the recording failed.
+#
+# Usage:
+#   python CoE199_batch_v9.py ./auscultawear/final_trials/ results.csv
+#   python CoE199_batch_v9.py "./corpus/**/FS*.wav" results.parquet --workers 8 --default 1
+#   python CoE199_batch_v9.py ./corpus/ results.csv --precision float32
+
+import CoE199_main_v9 as backend
+
+# These are the columns of the results, the stage columns follow the stage names of CoE199_main_v9.main
+stages = ['wav_to_array', 'bandpass_filter', 'hr_denoising', 'hr_reconstruction', 'hr_extract_features', 'hr_peak_detection',
+          'rr_denoising', 'rr_reconstruction', 'rr_extract_features', 'rr_peak_detection']
+columns = ['file', 'heart_rate', 'respiratory_rate'] + [f'{stage}_ms' for stage in stages] + ['total_ms', 'error']
+
+# This part is for finding the recordings
+# source is either a directory, which is searched for .wav files in all of its subdirectories, or a glob pattern
+def find_recordings(source, pattern = "*.wav"):
+    if os.path.isdir(source):
+        files = glob.glob(os.path.join(source, "**", pattern), recursive=True)
+    else:
+        files = glob.glob(source, recursive=True)
+    return sorted(files)
+
+# This part is for analyzing one recording inside a worker
+# Every error is caught and stored in the row so that a single bad file does not stop the batch
+def analyze_file(path, default = 0, precision = 'float64'):
+    row = dict.fromkeys(columns)
+    row['file'] = path
+    timings = {}
+    start = t.perf_counter_ns()
+    try:
+        filepath, filename = os.path.split(path)
+        # main prints its own runtime and the RR breakdown, which would only flood the console for thousands of files
+        with contextlib.redirect_stdout(io.StringIO()):
+            heartrate, respiratoryrate, _ = backend.main(filename, os.path.join(filepath, ""), default, timings, precision)
+        row['heart_rate'] = float(heartrate)
+        row['respiratory_rate'] = float(respiratoryrate)
+    except Exception as error:
+        row['error'] = f'{type(error).__name__}: {error}'
+    row['total_ms'] = (t.perf_counter_ns() - start) / 1e6
+    for stage in stages:
+        if stage in timings:
+            row[f'{stage}_ms'] = timings[stage] / 1e6
+    return row
+
+def analyze_file_args(args):
+    return analyze_file(*args)
+
+# This part is for writing the results
+# The format follows the extension of the output, .parquet needs pandas with pyarrow or fastparquet installed
+import csv
+def save_results(rows, output):
+    if output.endswith(".parquet"):
+        import pandas as pd
+        pd.DataFrame(rows, columns=columns).to_parquet(output, index=False)
+    else:
+        with open(output, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+
+# This part is for running the whole batch
+# workers defaults to every core of the machine. The rows keep the order of the files. Every worker is warmed up before
+# its first file, so the stage columns of the first files do not include the imports of the backend.
+from concurrent.futures import ProcessPoolExecutor
+def run_batch(source, output = None, workers = None, default = 0, pattern = "*.wav", precision = 'float64'):
+    files = find_recordings(source, pattern)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers == 1 or len(files) <= 1:
+        backend.warm_up()
+        rows = [analyze_file(path, default, precision) for path in files]
+    else:
+        # Several files per task keeps the inter-process overhead small next to the 20s recordings
+        chunksize = max(1, len(files) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, initializer=backend.warm_up) as executor:
+            rows = list(executor.map(analyze_file_args, [(path, default, precision) for path in files], chunksize=chunksize))
+
+    if output is not None:
+        save_results(rows, output)
+    return rows
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run the v9 backend on every recording of a directory or glob")
+    parser.add_argument("source", help="directory of recordings or glob pattern such as './corpus/**/FS*.wav'")
+    parser.add_argument("output", help="results file, .csv or .parquet")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes, defaults to every core")
+    parser.add_argument("--default", type=int, default=0, help="heart rate mode of main, 0 auto, 1 S-S, 2 P-P")
+    parser.add_argument("--pattern", default="*.wav", help="file pattern used when source is a directory")
+    parser.add_argument("--precision", default="float64", choices=["float64", "float32"], help="float32 reads int16 and halves the memory per recording")
+    args = parser.parse_args()
+
+    start = t.perf_counter()
+    rows = run_batch(args.source, args.output, args.workers, args.default, args.pattern, args.precision)
+    failed = sum(1 for row in rows if row['error'] is not None)
+    print(f'Analyzed {len(rows)} recordings ({failed} failed) in {t.perf_counter() - start:.2f}s -> {args.output}')
@@ -0,0 +1,176 @@
+import os
+import io
+import csv
+import contextlib
+import tempfile
+import time as t
+
+# This is the stage-level benchmark of the v9 backend
+# Every stage of the pipeline is timed on its own over synthetic recordings from 20s up to 8h, and the heart rate and
+# respiratory rate of every recording are compared against the rates the generator was asked for, so a change that makes
+# a stage slower or less accurate shows up in the same table. The original per-sample functions (bandpass_filter,
+# extract_features, hr_peak_detection, rr_peak_detection) are timed next to the stages main() uses, up to reference_limit
+# seconds of signal since they take minutes on long recordings, and their peaks are checked against the fast detectors.
+# --cold-start times fresh interpreters instead: importing the backend, importing it with every module it used to import
+# up front, backend.warm_up as the pool workers run it, and the whole single-file analysis of a CLI or serverless call,
+# with the heavy modules each one ended up loading.
+#
+# Usage:
+#   python CoE199_benchmark_v9.py
+#   python CoE199_benchmark_v9.py --lengths 20 600 3600 28800 --repeat 3 --output benchmark.csv
+#   python CoE199_benchmark_v9.py --cold-start --repeat 10
+
+import CoE199_main_v9 as backend
+import CoE199_synthetic_v9 as synthetic
+
+lengths = [20, 60, 600, 3600, 28800]                            # 20s, 1min, 10min, 1h, 8h
+hr_band = (10, 200)
+rr_band = (100, 950)
+
+# This part is for timing a single stage
+# The stage is run repeat times and the best time is kept, the output of the last run is returned. The first run of the
+# filter bank and the envelope stage also designs the filters and FFT plans, so repeat > 1 shows the cached cost.
+def time_stage(function, *args, repeat = 1):
+    best = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = t.perf_counter()
+            output = function(*args)
+            elapsed = t.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output
+
+# This part is for benchmarking one recording length
+def benchmark_length(duration, samplerate = 2000, heart_rate = 72, respiratory_rate = 16, repeat = 3, reference_limit = 60,
+                     seed = 0):
+    row = {'duration_s': duration, 'samples': int(duration*samplerate)}
+    timings = {}
+
+    # The recording goes through a wav file so that wav_to_array is timed on real file reading
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "synthetic.wav")
+        synthetic.save_synthetic(filename, duration, samplerate, heart_rate, respiratory_rate, seed=seed)
+        timings['wav_to_array'], (data, samplerate, time) = time_stage(backend.wav_to_array, filename, repeat=repeat)
+
+    n = len(data)
+    reference = duration <= reference_limit
+
+    timings['filter_bank'], (hr_filtered, rr_filtered) = time_stage(backend.filter_bank.apply, data, samplerate, [hr_band, rr_band], repeat=repeat)
+    if reference:
+        reference_filter = lambda: [backend.bandpass_filter(data, samplerate, *band) for band in (hr_band, rr_band)]
+        timings['bandpass_filter'], _ = time_stage(reference_filter, repeat=repeat)
+
+    timings['hr_denoising'], hr_coefficients = time_stage(backend.denoising_bands, hr_filtered, backend.wavelet, [5], repeat=repeat)
+    timings['rr_denoising'], rr_coefficients = time_stage(backend.denoising_bands, rr_filtered, backend.wavelet, [3], repeat=repeat)
+    timings['hr_reconstruction'], level5_wave = time_stage(backend.reconstruct_level, hr_coefficients[5], 5, backend.wavelet, n, repeat=repeat)
+    timings['rr_reconstruction'], level7_wave = time_stage(backend.reconstruct_level, rr_coefficients[3], 3, backend.wavelet, n, repeat=repeat)
+    if reference:
+        timings['denoising'], _ = time_stage(lambda: [backend.denoising(filtered, backend.wavelet) for filtered in (hr_filtered, rr_filtered)], repeat=repeat)
+
+    timings['envelope_stage'], (_, hr_envelope) = time_stage(backend.envelope_stage.extract_features, level5_wave, repeat=repeat)
+    _, (_, rr_envelope) = time_stage(backend.envelope_stage.extract_features, level7_wave)
+    if reference:
+        timings['extract_features'], _ = time_stage(backend.extract_features, level5_wave, repeat=repeat)
+
+    timings['hr_peak_detection_fast'], (heartrate, hr_peaks) = time_stage(backend.hr_peak_detection_fast, hr_envelope, time, samplerate, repeat=repeat)
+    timings['rr_peak_detection_fast'], (respiratoryrate, rr_peaks, _) = time_stage(backend.rr_peak_detection_fast, rr_envelope, time, samplerate, 1, repeat=repeat)
+    if reference:
+        timings['hr_peak_detection'], (_, reference_hr_peaks) = time_stage(backend.hr_peak_detection, hr_envelope, time, samplerate, repeat=repeat)
+        timings['rr_peak_detection'], (_, reference_rr_peaks, _) = time_stage(backend.rr_peak_detection, rr_envelope, time, samplerate, 1, repeat=repeat)
+        row['hr_peaks_match'] = reference_hr_peaks == hr_peaks
+        row['rr_peaks_match'] = reference_rr_peaks == rr_peaks
+
+    for stage, seconds in timings.items():
+        row[f'{stage}_ms'] = seconds * 1e3
+    row['heart_rate'] = heartrate
+    row['respiratory_rate'] = respiratoryrate
+    row['hr_error'] = abs(heartrate - heart_rate)
+    row['rr_error'] = abs(respiratoryrate - respiratory_rate)
+    return row
+
+def run_benchmark(lengths = lengths, samplerate = 2000, heart_rate = 72, respiratory_rate = 16, repeat = 3, reference_limit = 60,
+                  output = None):
+    # The stages of the first length would otherwise include the imports of the lazy modules
+    backend.warm_up(samplerate)
+    rows = []
+    for duration in lengths:
+        row = benchmark_length(duration, samplerate, heart_rate, respiratory_rate, repeat, reference_limit)
+        rows.append(row)
+        print_row(row)
+
+    if output is not None:
+        columns = []
+        for row in rows:
+            columns += [column for column in row if column not in columns]
+        with open(output, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
+
+# This part is for the cold start of a new interpreter
+# Every case runs repeat times in a new process from the directory of the backend and the median wall time is kept, the
+# interpreter start itself is the 'python' case
+# The modules the backend imported up front before the lazy imports. numba is not one of them, it was never imported there.
+heavy_modules = ['soundfile', 'scipy.signal', 'scipy.fft', 'pywt', 'matplotlib.pyplot']
+def cold_start_cases(filename):
+    path, name = os.path.split(os.path.abspath(filename))
+    analysis = (f"import io, contextlib\nimport CoE199_main_v9 as backend\n"
+                f"with contextlib.redirect_stdout(io.StringIO()): backend.main({name!r}, {os.path.join(path, '')!r})")
+    return {
+        'python': "pass",
+        'import': "import CoE199_main_v9",
+        'eager_import': "import " + ", ".join(heavy_modules) + "\nimport CoE199_main_v9",
+        'warm_up': "import CoE199_main_v9 as backend\nbackend.warm_up()",
+        'analysis': analysis,
+    }
+
+def cold_start(filename = None, repeat = 5):
+    import sys
+    import statistics
+    import subprocess
+    directory = os.path.dirname(os.path.abspath(__file__))
+    environment = dict(os.environ, MPLBACKEND='Agg')
+    with tempfile.TemporaryDirectory() as temporary:
+        if filename is None:
+            filename = synthetic.save_synthetic(os.path.join(temporary, "synthetic.wav"))
+        rows = []
+        for case, code in cold_start_cases(filename).items():
+            code += f"\nimport sys\nprint(','.join(m for m in {heavy_modules!r} if m in sys.modules))"
+            times = []
+            for _ in range(repeat):
+                start = t.perf_counter()
+                output = subprocess.run([sys.executable, "-c", code], cwd=directory, env=environment, check=True,
+                                        capture_output=True, text=True).stdout
+                times.append(t.perf_counter() - start)
+            loaded = output.strip().splitlines()[-1] if output.strip() else ''
+            rows.append({'case': case, 'cold_start_ms': statistics.median(times) * 1e3, 'loaded': loaded})
+            print(f"    {case:<16}{rows[-1]['cold_start_ms']:>10.1f} ms    {loaded or '-'}")
+    return rows
+
+def print_row(row):
+    print(f"{row['duration_s']}s ({row['samples']} samples)  HR {row['heart_rate']:.2f} (error {row['hr_error']:.2f})  "
+          f"RR {row['respiratory_rate']:.2f} (error {row['rr_error']:.2f})")
+    for column, value in row.items():
+        if column.endswith('_ms'):
+            print(f'    {column[:-3]:<24}{value:>12.2f} ms')
+        elif column.endswith('_match'):
+            print(f'    {column:<24}{str(value):>12}')
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Time every stage of the v9 backend on synthetic recordings")
+    parser.add_argument("--lengths", type=float, nargs="+", default=lengths, help="recording lengths in seconds")
+    parser.add_argument("--heart-rate", type=float, default=72)
+    parser.add_argument("--respiratory-rate", type=float, default=16)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the best is kept")
+    parser.add_argument("--reference-limit", type=float, default=60, help="longest length in seconds for the original per-sample functions")
+    parser.add_argument("--output", default=None, help="optional csv of the results")
+    parser.add_argument("--cold-start", action="store_true", help="time new interpreters instead of the stages")
+    parser.add_argument("--filename", default=None, help="wav file of the --cold-start analysis, a synthetic 20s recording by default")
+    args = parser.parse_args()
+
+    if args.cold_start:
+        cold_start(args.filename, args.repeat)
+        raise SystemExit
+    run_benchmark(args.lengths, 2000, args.heart_rate, args.respiratory_rate, args.repeat, args.reference_limit, args.output)
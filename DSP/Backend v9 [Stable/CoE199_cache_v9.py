@@ -0,0 +1,183 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+# This is the on-disk stage cache of the v9 backend
+# Every stage output of both branches (filtered input, denoised band, reconstructed band, envelope and the RR area) is
+# stored as a .npy file named after a hash of everything that went into it: the hash of the stage before it, the stage
+# name and the stage parameters, and for the first stage the samples and the samplerate themselves. A rerun computes the
+# keys of every stage without touching the audio, loads the last stage that is already cached (memory mapped), and only
+# runs the stages after it. The peak detectors always run, so a change of their settings costs only the detection.
+# The cache is bounded by size, the entries that were used the longest time ago are removed first. The entries the current
+# run used are never removed, the arrays it returns are still memory mapped from them and Windows does not delete open files.
+# Every key is salted with the cache version, which goes up whenever a stage computes something different for the same
+# parameters, so the entries of an older backend are never loaded and simply age out.
+#
+# Usage:
+#   cache = StageCache("./.stage_cache", max_bytes=2**30)
+#   results = analyze_cached(data, samplerate, cache)
+#   python CoE199_cache_v9.py FS2_5.wav --cache ./.stage_cache --max-size 1024
+
+import CoE199_main_v9 as backend
+
+cache_version = b'CoE199_v9/1'                                  # at most 16 bytes, the personalization of blake2b
+
+# This part is for the cache directory
+# used holds the keys loaded or stored since the last begin(), evict leaves them alone
+class StageCache:
+    def __init__(self, directory, max_bytes = 2**30, salt = cache_version):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.salt = salt
+        self.used = set()
+        os.makedirs(directory, exist_ok=True)
+
+    def begin(self):
+        self.used = set()
+
+    def key(self, *parts):
+        # Arrays are hashed by their dtype, shape and bytes, everything else by its repr
+        digest = hashlib.blake2b(digest_size=16, person=self.salt)
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                part = np.ascontiguousarray(part)
+                digest.update(f'{part.dtype.str}{part.shape}'.encode())
+                digest.update(memoryview(part).cast('B'))
+            else:
+                digest.update(repr(part).encode())
+            digest.update(b'|')
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def get(self, key):
+        # Returns the memory mapped array or None, a hit counts as a use for the eviction
+        path = self.path(key)
+        try:
+            array = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+        os.utime(path)
+        self.used.add(key)
+        return array
+
+    def put(self, key, array):
+        # Written to a temporary file first so that another process never loads half an entry
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(descriptor, "wb") as file:
+            np.save(file, np.asarray(array))
+        os.replace(temporary, self.path(key))
+        self.used.add(key)
+
+    def entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        # Removes the least recently used entries until the cache fits in max_bytes, except the ones of the current run
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        used = {self.path(key) for key in self.used}
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path in used:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except PermissionError:
+                # Still mapped by an array of an earlier run on Windows, it goes on a later eviction
+                continue
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            os.remove(path)
+
+# This part is for running a chain of stages through the cache
+# stages is a list of (name, parameters, function), every function takes the output of the stage before it. Returns the
+# output of the last stage and the names of the stages that were skipped.
+def run_stages(cache, source_key, source, stages):
+    keys = []
+    key = source_key
+    for name, parameters, _ in stages:
+        key = cache.key(key, name, parameters)
+        keys.append(key)
+
+    start = 0
+    value = source
+    for s in range(len(stages) - 1, -1, -1):
+        cached = cache.get(keys[s])
+        if cached is not None:
+            start, value = s + 1, cached
+            break
+
+    for s in range(start, len(stages)):
+        value = stages[s][2](value)
+        cache.put(keys[s], value)
+    return value, [name for name, _, _ in stages[:start]]
+
+# This part is for the cached pipeline
+# Same stages and results as analyze in CoE199_main_v9, the dict also has the stages that came from the cache
+def analyze_cached(data, samplerate, cache, default = 0, precision = 'float64'):
+    wavelet = backend.wavelet
+    n = len(data)
+    time = backend.TimeAxis(samplerate, n)
+    cache.begin()
+    source_key = cache.key(np.asarray(data), samplerate)
+    source = lambda: np.asarray(data, dtype=precision)
+
+    hr_stages = [
+        ('bandpass_filter', (10, 200, backend.filter_bank.order, precision),
+            lambda _: backend.filter_bank.filter(source(), samplerate, 10, 200)),
+        ('denoising', (wavelet, 5), lambda filtered: backend.denoising_bands(filtered, wavelet, [5])[5]),
+        ('reconstruction', (wavelet, 5, n), lambda band: backend.reconstruct_level(band, 5, wavelet, n)),
+        ('extract_features', (), lambda wave: backend.envelope_stage.envelope(wave)),
+    ]
+    rr_stages = [
+        ('bandpass_filter', (100, 950, backend.filter_bank.order, precision),
+            lambda _: backend.filter_bank.filter(source(), samplerate, 100, 950)),
+        ('denoising', (wavelet, 3), lambda filtered: backend.denoising_bands(filtered, wavelet, [3])[3]),
+        ('reconstruction', (wavelet, 3, n), lambda band: backend.reconstruct_level(band, 3, wavelet, n)),
+        ('extract_features', (), lambda wave: backend.envelope_stage.envelope(wave)),
+        ('area', (samplerate//2,), lambda envelope: backend.normalized_area(envelope, samplerate)),
+    ]
+
+    hr_envelope, hr_cached = run_stages(cache, source_key, None, hr_stages)
+    rr_area, rr_cached = run_stages(cache, source_key, None, rr_stages)
+    cache.evict()
+
+    heartrate, hr_peaks = backend.hr_peak_detection_fast(hr_envelope, time, samplerate, default)
+    respiratoryrate, rr_peaks, _ = backend.rr_peaks_from_area(rr_area, time, samplerate, 1)
+    return {
+        'heartrate': heartrate, 'respiratoryrate': respiratoryrate, 'samplerate': samplerate, 'time': time,
+        'hr_envelope': hr_envelope, 'hr_peaks': hr_peaks, 'rr_area': rr_area, 'rr_peaks': rr_peaks,
+        'hr_cached': ['hr_' + name for name in hr_cached], 'rr_cached': ['rr_' + name for name in rr_cached],
+    }
+
+if __name__ == "__main__":
+    import argparse
+    import time as t
+    parser = argparse.ArgumentParser(description="Run the v9 backend on a recording with an on-disk stage cache")
+    parser.add_argument("filename", help="wav file of the recording")
+    parser.add_argument("--cache", default="./.stage_cache", help="cache directory")
+    parser.add_argument("--max-size", type=float, default=1024, help="size limit of the cache in MB")
+    parser.add_argument("--default", type=int, default=0, help="heart rate mode of main, 0 auto, 1 S-S, 2 P-P")
+    args = parser.parse_args()
+
+    start = t.perf_counter()
+    data, samplerate, _ = backend.wav_to_array(args.filename)
+    results = analyze_cached(data, samplerate, StageCache(args.cache, int(args.max_size * 2**20)), args.default)
+    print(f'HR {results["heartrate"]:.2f} BPM\tRR {results["respiratoryrate"]:.2f} BPM\tin {t.perf_counter() - start:.3f}s, '
+          f'cached: {", ".join(results["hr_cached"] + results["rr_cached"]) or "none"}')
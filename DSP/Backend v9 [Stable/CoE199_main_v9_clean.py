@@ -27,7 +27,6 @@ def denoising(data, wavelet):
     return denoised_coefficients
 
 def extract_features(data):
-    squared_signal = np.square(data)
     envelope = np.abs(signal.hilbert(data))
     return envelope
 
@@ -0,0 +1,134 @@
+import io
+import contextlib
+import numpy as np
+
+# This is the motion gate of the v9 backend
+# The firmware keeps the accelerometer magnitude at 100Hz in imu_buf next to the 2kHz audio and latches motion_flag when
+# the magnitude goes over MOTION_THRESHOLD (15 m/s^2). Movement of the stethoscope shows up in the audio as loud rubbing
+# that the filters, the wavelets and the envelope pass on as peaks. analyze_with_motion finds the IMU samples over the same
+# threshold, stretches them to the audio samples they cover plus padding seconds on both sides, and runs analyze only on
+# the spans between them that are at least hr_minimum seconds long. The samples under motion never go through the filters,
+# the wavelets or the detectors, and no heart or breath interval is measured across a motion span.
+#
+# A 5s span holds several heartbeats but only one or two breaths, so the respiratory rate is only taken from the spans that
+# are at least rr_minimum seconds long. The rates of the clean spans are averaged by their length, and the peaks of every
+# span are returned as Peaks of the whole recording. hr_spans and rr_spans count the spans each rate came from, and errors
+# lists (start, end, message) of every span analyze failed on. A recording without motion goes through analyze once and
+# gets the same results, with the same minimums and the same counts as one clean span, so a still recording shorter than
+# rr_minimum has no respiratory rate either. A recording without any clean span long enough gets NaN rates without any of
+# the DSP.
+#
+# Usage:
+#   results = analyze_with_motion(data, samplerate, recording.imu)
+#   results = analyze_recording(nus.decode(payload))
+#   python CoE199_motion_v9.py transfer.bin --threshold 15
+
+import CoE199_main_v9 as backend
+import CoE199_nus_v9 as nus
+
+motion_threshold = 15                                           # MOTION_THRESHOLD in m/s^2
+
+# This part is for aligning the IMU to the audio
+# IMU sample k covers the audio samples from k*samplerate/imu_samplerate up to the next IMU sample. The audio after the last
+# IMU sample, when the IMU stopped early, counts as still. imu is stored like imu_buf, magnitude * 100.
+def motion_mask(imu, n, samplerate = nus.audio_samplerate, imu_samplerate = nus.imu_samplerate, threshold = motion_threshold,
+                padding = 0.25):
+    moving = np.asarray(imu) / nus.imu_scale > threshold
+    if not moving.any():
+        return np.zeros(n, dtype=bool)
+    # Padding is applied on the IMU samples, the rubbing starts a little before the accelerometer sees the movement
+    pad = int(np.ceil(padding*imu_samplerate))
+    if pad:
+        moving = np.convolve(moving, np.ones(2*pad + 1), mode='same') > 0
+    edges = (np.arange(moving.size + 1) * samplerate) // imu_samplerate
+    mask = np.zeros(n, dtype=bool)
+    for start, end in spans(moving):
+        mask[min(edges[start], n):min(edges[end], n)] = True
+    return mask
+
+def spans(mask):
+    # (start, end) of every run of True, end excluded
+    changes = np.flatnonzero(np.diff(np.concatenate(([0], mask.astype(np.int8), [0]))))
+    return changes.reshape(-1, 2)
+
+def clean_spans(mask, samplerate, minimum = 5):
+    # The spans without motion that are at least minimum seconds long
+    clean = spans(~mask)
+    return clean[clean[:, 1] - clean[:, 0] >= minimum*samplerate]
+
+# This part is for running the pipeline on the clean spans
+def analyze_with_motion(data, samplerate, imu, imu_samplerate = nus.imu_samplerate, default = 0, threshold = motion_threshold,
+                        padding = 0.25, hr_minimum = 5, rr_minimum = 15, precision = 'float64'):
+    n = len(data)
+    mask = motion_mask(imu, n, samplerate, imu_samplerate, threshold, padding)
+    if not mask.any() and n >= hr_minimum*samplerate:
+        results = backend.analyze(data, samplerate, default=default, precision=precision)
+        if n < rr_minimum*samplerate:
+            results.update(respiratoryrate=np.nan, rr_peaks=backend.Peaks([], n))
+        results.update(motion=mask, segments=np.array([[0, n]]), masked=0.0, hr_spans=count_rates([results['heartrate']]),
+                       rr_spans=count_rates([results['respiratoryrate']]), errors=[])
+        return results
+
+    segments = clean_spans(mask, samplerate, hr_minimum)
+    heart_rates, hr_weights, respiratory_rates, rr_weights = [], [], [], []
+    hr_peaks, rr_peaks, errors = [], [], []
+    for start, end in segments:
+        with contextlib.redirect_stdout(io.StringIO()), np.errstate(all='ignore'):
+            try:
+                results = backend.analyze(data[start:end], samplerate, default=default, precision=precision)
+            except (ValueError, IndexError) as error:
+                errors.append((int(start), int(end), str(error)))
+                continue
+        heart_rates.append(results['heartrate'])
+        hr_weights.append(end - start)
+        hr_peaks.append(results['hr_peaks'].indices + start)
+        if end - start >= rr_minimum*samplerate:
+            respiratory_rates.append(results['respiratoryrate'])
+            rr_weights.append(end - start)
+            rr_peaks.append(results['rr_peaks'].indices + start)
+
+    return {
+        'heartrate': weighted_rate(heart_rates, hr_weights), 'respiratoryrate': weighted_rate(respiratory_rates, rr_weights),
+        'samplerate': samplerate, 'time': backend.TimeAxis(samplerate, n),
+        'hr_peaks': backend.Peaks(np.concatenate(hr_peaks) if hr_peaks else [], n),
+        'rr_peaks': backend.Peaks(np.concatenate(rr_peaks) if rr_peaks else [], n),
+        'motion': mask, 'segments': segments, 'masked': float(np.mean(mask)),
+        'hr_spans': count_rates(heart_rates), 'rr_spans': count_rates(respiratory_rates), 'errors': errors,
+    }
+
+def count_rates(rates):
+    # The spans that gave a rate, NaN rates are left out of the average as well
+    return int(np.count_nonzero(np.isfinite(np.asarray(rates, dtype=np.float64))))
+
+def weighted_rate(rates, weights):
+    rates = np.asarray(rates, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    valid = np.isfinite(rates)
+    if not valid.any():
+        return np.nan
+    return float(np.average(rates[valid], weights=weights[valid]))
+
+def analyze_recording(recording, default = 0, threshold = motion_threshold, padding = 0.25, hr_minimum = 5, rr_minimum = 15):
+    data, samplerate, _ = nus.to_pipeline(recording)
+    return analyze_with_motion(data, samplerate, recording.imu, recording.imu_samplerate, default, threshold, padding,
+                               hr_minimum, rr_minimum)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run the v9 backend on a raw NUS transfer, skipping the spans with motion")
+    parser.add_argument("filename", help="bytes of one transfer: audio, \"finished\\n\", IMU, \"IMU\\n\"")
+    parser.add_argument("--threshold", type=float, default=motion_threshold, help="motion magnitude in m/s^2")
+    parser.add_argument("--padding", type=float, default=0.25, help="seconds masked on both sides of the motion")
+    parser.add_argument("--hr-minimum", type=float, default=5, help="shortest clean span in seconds for the heart rate")
+    parser.add_argument("--rr-minimum", type=float, default=15, help="shortest clean span in seconds for the respiratory rate")
+    parser.add_argument("--default", type=int, default=0, help="heart rate mode of main, 0 auto, 1 S-S, 2 P-P")
+    args = parser.parse_args()
+
+    with open(args.filename, "rb") as file:
+        recording = nus.decode(file.read())
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = analyze_recording(recording, args.default, args.threshold, args.padding, args.hr_minimum, args.rr_minimum)
+    print(f'HR {results["heartrate"]:.2f} BPM from {results["hr_spans"]} spans\tRR {results["respiratoryrate"]:.2f} BPM from '
+          f'{results["rr_spans"]} spans\t{results["masked"]*100:.1f}% masked, {len(results["segments"])} clean spans')
+    for start, end, message in results["errors"]:
+        print(f'    span {start/recording.samplerate:.2f}-{end/recording.samplerate:.2f}s failed: {message}')
@@ -0,0 +1,100 @@
+import numpy as np
+
+# This is the decoder of the BLE NUS byte stream sent by the firmware
+# After a recording, stream_audio() in Hardware/CAREM1/src/main.c sends
+#   1. the audio, raw little-endian int16 ADC samples at 2kHz, where -1 marks a failed ADC read
+#   2. the footer "finished\n"
+#   3. the IMU motion magnitude, raw little-endian int16 at 100Hz, scaled by 100 (981 is 9.81 m/s^2)
+#   4. the footer "IMU\n"
+# The continuous mode only sends the audio and "finished\n". The arrays of a Recording are views into the received bytes
+# made with np.frombuffer, nothing is copied until the pipeline needs floating point samples.
+#
+# Usage:
+#   recording = decode(payload)                 # bytes of one whole transfer
+#   heartrate, respiratoryrate = analyze_payload(payload)
+
+audio_footer = b"finished\n"
+imu_footer = b"IMU\n"
+audio_samplerate = 2000                                         # MIC_SAMPLE_RATE_HZ
+imu_samplerate = 100                                            # IMU_SAMPLE_RATE_HZ
+imu_scale = 100                                                 # imu_buf stores motion_magnitude * 100
+failed_read = -1                                                # written to electret_buf when adc_read fails
+
+# This part is for a decoded recording
+# audio and imu are read-only int16 views of the payload, failed marks the audio samples where the ADC read failed
+class Recording:
+    __slots__ = ('audio', 'imu', 'failed', 'samplerate', 'imu_samplerate')
+
+    def __init__(self, audio, imu, samplerate = audio_samplerate, imu_samplerate = imu_samplerate):
+        self.audio = audio
+        self.imu = imu
+        self.failed = audio == failed_read
+        self.samplerate = samplerate
+        self.imu_samplerate = imu_samplerate
+
+    def motion(self):
+        # IMU motion magnitude in m/s^2
+        return self.imu / imu_scale
+
+    def __repr__(self):
+        return (f'Recording({self.audio.size} audio samples, {self.imu.size} IMU samples, '
+                f'{int(np.count_nonzero(self.failed))} failed reads)')
+
+# This part is for finding a footer
+# Audio samples are 12-bit, so every high byte of a sample is 0x00-0x0F or 0xFF for a failed read, and the letters of the
+# footers can never line up with the samples. The footer is only accepted at an even offset from the start of the block.
+def find_footer(payload, footer, start = 0):
+    index = payload.find(footer, start)
+    while index >= 0 and (index - start) % 2:
+        index = payload.find(footer, index + 1)
+    return index
+
+def int16_view(payload, start, end):
+    end -= (end - start) % 2                                    # a stray byte cannot be half of a sample
+    return np.frombuffer(payload, dtype='<i2', count=(end - start)//2, offset=start)
+
+# This part is for decoding one transfer
+# payload is the bytes or bytearray of the whole transfer, or a list of the NUS packets which are joined first (the only copy)
+def decode(payload, samplerate = audio_samplerate):
+    if isinstance(payload, (list, tuple)):
+        payload = b''.join(payload)
+
+    audio_end = find_footer(payload, audio_footer)
+    if audio_end < 0:
+        # No footer yet, everything is audio
+        return Recording(int16_view(payload, 0, len(payload)), np.empty(0, dtype='<i2'), samplerate)
+
+    imu_start = audio_end + len(audio_footer)
+    imu_end = find_footer(payload, imu_footer, imu_start)
+    if imu_end < 0:
+        imu_end = imu_start
+    return Recording(int16_view(payload, 0, audio_end), int16_view(payload, imu_start, imu_end), samplerate)
+
+# This part is for replacing the failed reads
+# Every failed read is replaced with the last good sample before it, so the filters do not see a jump from the ADC mid-scale
+# down to -1. previous is the last good sample of the chunk before, for streams that arrive in pieces.
+def hold_failed(samples, failed = None, previous = None):
+    samples = np.asarray(samples, dtype=np.float64)
+    if failed is None:
+        failed = samples == failed_read
+    if not failed.any():
+        return samples
+    # index of the last good sample at or before every sample, -1 when the samples start with failed reads
+    index = np.maximum.accumulate(np.where(failed, -1, np.arange(samples.size)))
+    if previous is None:
+        good = np.flatnonzero(~failed)
+        previous = samples[good[0]] if good.size else 0
+    return np.where(index < 0, previous, samples[np.maximum(index, 0)])
+
+# This part is for handing a recording to the pipeline
+# Returns data, samplerate and time like wav_to_array, so the rest of the backend does not need a wav file. time is a
+# TimeAxis of the backend instead of a full array.
+import CoE199_main_v9 as backend
+def to_pipeline(recording):
+    data = hold_failed(recording.audio, recording.failed)
+    return data, recording.samplerate, backend.TimeAxis(recording.samplerate, len(data))
+
+def analyze_payload(payload, default = 0):
+    data, samplerate, time = to_pipeline(decode(payload))
+    results = backend.analyze(data, samplerate, time, default)
+    return results['heartrate'], results['respiratoryrate']
@@ -0,0 +1,158 @@
+import io
+import contextlib
+import numpy as np
+
+# This is the signal quality check of the v9 backend
+# A lot of uploads are not worth the pipeline: the stethoscope is off the body, the ADC clips, the reads failed, or the
+# microphone is silent. They still went through denoising and both detectors and came out as NaN with warnings from np.mean
+# on empty intervals. signal_quality scores a recording in a fraction of a millisecond before any of that, and
+# analyze_checked only runs analyze when every score is inside its limit.
+#
+# The checks run cheapest first and stop at the first one that fails:
+#   failed      fraction of samples that are the -1 the firmware writes when an ADC read fails. Only raw int16 samples are
+#               checked, -1.0 is an ordinary sample of a float wav
+#   flat        fraction of samples in runs of one value longer than flat_run seconds, a silent or disconnected microphone.
+#               A quiet recording that moves a few LSB still changes value every few samples, a stuck ADC does not
+#   clipped     fraction of samples at the largest or smallest value of the recording beyond the one each that any
+#               recording has, a saturated ADC
+#   band_ratio  energy of the heart band (10-200Hz) over the energy of the whole band the pipeline uses (10-950Hz). Off the
+#               body the microphone mostly hears hiss, which is flat over the band and gives about 0.2. It is estimated from
+#               segments short windows spread over the recording instead of the whole spectrum.
+#
+# Usage:
+#   quality = signal_quality(recording.audio, 2000)
+#   results = analyze_checked(data, samplerate)        # results['quality'] is the Quality, rates are NaN when it failed
+
+import CoE199_main_v9 as backend
+import CoE199_nus_v9 as nus
+
+# Largest fraction for failed, flat and clipped, smallest ratio for band_ratio
+limits = {'failed': 0.05, 'flat': 0.5, 'clipped': 0.01, 'band_ratio': 0.3}
+flat_run = 0.05                                                 # 100 samples at 2kHz
+
+# This part is for the verdict
+# score is the smallest margin of the checks that ran, 1 is a perfect recording and a score of 0 or below failed a limit.
+# The checks after a failed one are None, and so is failed for a recording that is not raw int16.
+class Quality:
+    __slots__ = ('failed', 'flat', 'clipped', 'band_ratio', 'score', 'reasons')
+
+    def __init__(self):
+        self.failed = None
+        self.flat = None
+        self.clipped = None
+        self.band_ratio = None
+        self.score = 1.0
+        self.reasons = []
+
+    @property
+    def passed(self):
+        return not self.reasons
+
+    def check(self, name, value, limits):
+        setattr(self, name, value)
+        limit = limits[name]
+        if name == 'band_ratio':
+            margin = (value - limit) / (1 - limit)
+        else:
+            margin = 1 - value / limit
+        self.score = min(self.score, margin)
+        if margin <= 0:
+            self.reasons.append(name)
+        return margin > 0
+
+    def __repr__(self):
+        values = ', '.join(f'{name}={getattr(self, name):.3f}' for name in limits if getattr(self, name) is not None)
+        return f'Quality({"passed" if self.passed else "failed " + "/".join(self.reasons)}, score={self.score:.2f}, {values})'
+
+# This part is for scoring a recording
+# data is the recording as it came from the device, before hold_failed replaces the failed reads
+def raw(data):
+    # Only the int16 samples of the ADC can hold a failed read
+    return data.dtype == np.int16
+
+def flat_fraction(data, samplerate, run = flat_run):
+    # Lengths of the runs of one value from the samples where the value changes
+    changes = np.flatnonzero(data[1:] != data[:-1]) + 1
+    lengths = np.diff(np.concatenate(([0], changes, [data.size])))
+    return float(lengths[lengths >= max(2, int(run*samplerate))].sum() / data.size)
+
+def band_ratio(data, samplerate, segments = 16, size = 512):
+    size = min(size, data.size)
+    starts = np.linspace(0, data.size - size, segments).astype(np.intp)
+    windows = data[starts[:, None] + np.arange(size)].astype(np.float64)
+    # Failed reads are set to the mean of their window, which only takes out their energy
+    failed = windows == nus.failed_read if raw(data) else np.zeros(windows.shape, dtype=bool)
+    if failed.any():
+        good = np.maximum(np.sum(~failed, axis=1, keepdims=True), 1)
+        windows[failed] = 0
+        windows = np.where(failed, windows.sum(axis=1, keepdims=True) / good, windows)
+    windows -= windows.mean(axis=1, keepdims=True)
+    power = np.sum(np.abs(np.fft.rfft(windows * np.hanning(size), axis=1))**2, axis=0)
+    frequency = np.fft.rfftfreq(size, 1/samplerate)
+    total = power[(frequency >= 10) & (frequency < 950)].sum()
+    return float(power[(frequency >= 10) & (frequency < 200)].sum() / total) if total > 0 else 0.0
+
+def signal_quality(data, samplerate, limits = limits, segments = 16, size = 512, run = flat_run):
+    data = np.asarray(data)
+    quality = Quality()
+    n = data.size
+    if n < 2:
+        quality.check('flat', 1.0, limits)
+        return quality
+
+    failed = data == nus.failed_read if raw(data) else np.zeros(n, dtype=bool)
+    if raw(data) and not quality.check('failed', np.count_nonzero(failed) / n, limits):
+        return quality
+    if not quality.check('flat', flat_fraction(data, samplerate, run), limits):
+        return quality
+
+    good = data[~failed] if failed.any() else data
+    at_extremes = np.count_nonzero(good == good.max()) + np.count_nonzero(good == good.min())
+    if not quality.check('clipped', max(0, at_extremes - 2) / n, limits):
+        return quality
+
+    quality.check('band_ratio', band_ratio(data, samplerate, segments, size), limits)
+    return quality
+
+# This part is for the pipeline behind the check
+# Returns the results of analyze with the Quality under 'quality', or only the rates as NaN and the Quality when it failed
+def analyze_checked(data, samplerate, default = 0, limits = limits, precision = 'float64'):
+    quality = signal_quality(data, samplerate, limits)
+    if not quality.passed:
+        return {'heartrate': np.nan, 'respiratoryrate': np.nan, 'samplerate': samplerate, 'quality': quality}
+    data = np.asarray(data)
+    data = nus.hold_failed(data) if raw(data) and np.any(data == nus.failed_read) else data
+    results = backend.analyze(data, samplerate, default=default, precision=precision)
+    results['quality'] = quality
+    return results
+
+def analyze_payload(payload, default = 0, limits = limits):
+    # Like analyze_payload of CoE199_nus_v9, the raw samples of the transfer are checked before the failed reads are held
+    recording = nus.decode(payload)
+    quality = signal_quality(recording.audio, recording.samplerate, limits)
+    if not quality.passed:
+        return np.nan, np.nan, quality
+    data, samplerate, time = nus.to_pipeline(recording)
+    results = backend.analyze(data, samplerate, time, default)
+    return results['heartrate'], results['respiratoryrate'], quality
+
+if __name__ == "__main__":
+    import argparse
+    import time as t
+    parser = argparse.ArgumentParser(description="Score the signal quality of wav recordings before the v9 backend")
+    parser.add_argument("filenames", nargs="+", help="wav files of the recordings")
+    parser.add_argument("--analyze", action="store_true", help="also run the pipeline on the recordings that pass")
+    args = parser.parse_args()
+
+    for filename in args.filenames:
+        # int16 keeps the samples as the ADC wrote them, so -1 still marks a failed read
+        data, samplerate, _ = backend.wav_to_array(filename, 'int16')
+        start = t.perf_counter()
+        quality = signal_quality(data, samplerate)
+        elapsed = t.perf_counter() - start
+        line = f'{filename}: {quality} in {elapsed*1e3:.3f}ms'
+        if args.analyze and quality.passed:
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = analyze_checked(data, samplerate)
+            line += f'\tHR {results["heartrate"]:.2f} BPM\tRR {results["respiratoryrate"]:.2f} BPM'
+        print(line)
@@ -0,0 +1,205 @@
+import asyncio
+import collections
+import time as t
+import numpy as np
+
+# This is the scheduler between the ingestion server and the workers of the v9 backend
+# When every device finishes its 20s recording at about the same time, every session hands its transfer to the pool at once
+# and the answers get later and later. Scheduler keeps the work in a bounded queue in front of the pool instead:
+#   - at most workers jobs run at once, the rest wait in the queue
+#   - every device has its own queue and the devices take turns, so a device that sends a lot cannot hold back the others
+#   - the rates (HR/RR) always go before the debug work (the wav exports of the debug artifacts), which only runs when no
+#     rates are waiting
+#   - when the queue is full a new debug job is shed right away, and a new rates job sheds the oldest queued debug job. When
+#     there is no debug job left to shed, the rates job waits for space, which holds back the session that submitted it.
+#     per_device bounds the jobs of one device in the same way.
+# stats() gives the queue depth and the wait time of every priority for monitoring.
+#
+# Usage:
+#   scheduler = Scheduler(executor, workers=4, capacity=64)
+#   heartrate, respiratoryrate, error = await scheduler.submit("device-1", analyze_transfer, payload)
+#   server = IngestionServer(scheduler=scheduler, debug_directory="./debug")
+
+rates = 0
+debug = 1
+priority_names = {rates: 'rates', debug: 'debug'}
+
+class Shed(RuntimeError):
+    pass
+
+# This part is for a queued job
+class Job:
+    __slots__ = ('device', 'priority', 'function', 'args', 'future', 'submitted')
+
+    def __init__(self, device, priority, function, args, future):
+        self.device = device
+        self.priority = priority
+        self.function = function
+        self.args = args
+        self.future = future
+        self.submitted = t.perf_counter()
+
+# This part is for the wait times of one priority
+# The wait is the time from submit to the start in the executor. Only the last history waits are kept, so the percentiles
+# follow the current load
+class WaitStats:
+    def __init__(self, history = 1000):
+        self.waits = collections.deque(maxlen=history)
+        self.started = 0
+        self.shed = 0
+
+    def add(self, wait):
+        self.waits.append(wait)
+        self.started += 1
+
+    def summary(self):
+        waits = np.array(self.waits)
+        summary = {'started': self.started, 'shed': self.shed}
+        if waits.size:
+            summary.update(wait_mean_ms=float(np.mean(waits))*1e3, wait_p95_ms=float(np.percentile(waits, 95))*1e3,
+                           wait_max_ms=float(np.max(waits))*1e3)
+        return summary
+
+# This part is for the scheduler
+# executor - pool the jobs run in, None runs them in the default executor of the event loop
+# workers - jobs running at once, should match the workers of the executor
+# capacity - queued jobs of every device and priority together
+# per_device - queued jobs of one device, None for no limit
+class Scheduler:
+    def __init__(self, executor = None, workers = 1, capacity = 64, per_device = 4):
+        self.executor = executor
+        self.workers = workers
+        self.capacity = capacity
+        self.per_device = per_device
+        self.queues = {priority: collections.OrderedDict() for priority in priority_names}     # device -> deque of jobs
+        self.depth = 0
+        self.max_depth = 0
+        self.running = 0
+        self.stats_of = {priority: WaitStats() for priority in priority_names}
+        self.space = None
+
+    def queued(self, device):
+        return sum(len(queue.get(device, ())) for queue in self.queues.values())
+
+    def has_space(self, device):
+        return self.depth < self.capacity and (self.per_device is None or self.queued(device) < self.per_device)
+
+    def shed_debug(self):
+        # Sheds the oldest queued debug job of the device that has the most of them, returns False when there is none
+        queue = self.queues[debug]
+        if not queue:
+            return False
+        device = max(queue, key=lambda device: len(queue[device]))
+        job = queue[device].popleft()
+        if not queue[device]:
+            del queue[device]
+        self.depth -= 1
+        self.stats_of[debug].shed += 1
+        if not job.future.done():
+            job.future.set_exception(Shed(f'debug job of {job.device} shed, queue full'))
+        return True
+
+    def enqueue(self, job):
+        self.queues[job.priority].setdefault(job.device, collections.deque()).append(job)
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+
+    def next_job(self):
+        # The device at the front of the queue gets one job and goes to the back
+        for priority in sorted(self.queues):
+            queue = self.queues[priority]
+            if queue:
+                device, jobs = next(iter(queue.items()))
+                job = jobs.popleft()
+                if jobs:
+                    queue.move_to_end(device)
+                else:
+                    del queue[device]
+                self.depth -= 1
+                return job
+        return None
+
+    def pump(self):
+        loop = asyncio.get_running_loop()
+        while self.running < self.workers:
+            job = self.next_job()
+            if job is None:
+                break
+            self.running += 1
+            self.stats_of[job.priority].add(t.perf_counter() - job.submitted)
+            task = loop.run_in_executor(self.executor, job.function, *job.args)
+            task.add_done_callback(lambda task, job=job: self.finish(job, task))
+        self.notify()
+
+    def finish(self, job, task):
+        self.running -= 1
+        if not job.future.done():
+            if task.cancelled():
+                job.future.cancel()
+            elif task.exception() is not None:
+                job.future.set_exception(task.exception())
+            else:
+                job.future.set_result(task.result())
+        self.pump()
+
+    def notify(self):
+        if self.space is not None:
+            self.space.set()
+
+    async def submit(self, device, function, *args, priority = rates):
+        # Returns what function(*args) returns once it ran in the executor, raises Shed when a debug job is shed
+        if self.space is None:
+            self.space = asyncio.Event()
+        while not self.has_space(device):
+            if priority == debug:
+                self.stats_of[debug].shed += 1
+                raise Shed(f'debug job of {device} shed, queue full')
+            # Shedding only makes room when the whole queue is full, not when this device is at per_device
+            if self.depth >= self.capacity and self.shed_debug() and self.has_space(device):
+                break
+            self.space.clear()
+            await self.space.wait()
+
+        future = asyncio.get_running_loop().create_future()
+        self.enqueue(Job(device, priority, function, args, future))
+        self.pump()
+        return await future
+
+    def stats(self):
+        stats = {'depth': self.depth, 'max_depth': self.max_depth, 'running': self.running,
+                 'devices_waiting': len(set().union(*[queue.keys() for queue in self.queues.values()]))}
+        for priority, name in priority_names.items():
+            for key, value in self.stats_of[priority].summary().items():
+                stats[f'{name}_{key}'] = value
+        return stats
+
+if __name__ == "__main__":
+    # A burst of simulated devices that all finish their recordings at the same time, with debug artifacts turned on
+    import argparse
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    import CoE199_main_v9 as backend
+    import CoE199_server_v9 as server_module
+    parser = argparse.ArgumentParser(description="Run a burst of simulated devices through the scheduler")
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--capacity", type=int, default=32)
+    args = parser.parse_args()
+
+    async def burst():
+        executor = ProcessPoolExecutor(max_workers=args.workers, initializer=backend.warm_up)
+        scheduler = Scheduler(executor, args.workers, args.capacity)
+        with tempfile.TemporaryDirectory() as directory:
+            server = server_module.IngestionServer(executor, record_seconds=0, scheduler=scheduler, debug_directory=directory)
+            devices = [server_module.synthetic_device(60 + 5*(d % 7), 12 + (d % 5), speed=None, seed=d) for d in range(args.devices)]
+            start = t.perf_counter()
+            results = await server_module.simulate(server, devices)
+            await server.close()
+            elapsed = t.perf_counter() - start
+        return results, scheduler.stats(), elapsed
+
+    results, stats, elapsed = asyncio.run(burst())
+    latencies = np.array([result.latency for result in results if result.error is None])
+    print(f'{len(results)} recordings in {elapsed:.2f}s, latency median {np.median(latencies)*1e3:.1f}ms, max {latencies.max()*1e3:.1f}ms')
+    for key, value in stats.items():
+        print(f'    {key:<24}{value:>12.2f}' if isinstance(value, float) else f'    {key:<24}{value:>12}')
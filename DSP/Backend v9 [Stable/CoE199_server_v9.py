@@ -0,0 +1,348 @@
+import os
+import io
+import socket
+import asyncio
+import contextlib
+import time as t
+import numpy as np
+
+# This is the ingestion server of the v9 backend for many wearables at once
+# Every device gets its own session on one asyncio event loop. A session follows the manual mode of the firmware: the server
+# sends "rec", waits the recording time, sends "send", and reads the transfer of stream_audio() (the audio in 200 byte NUS
+# packets, "finished\n", the IMU in 200 byte packets, "IMU\n") into one buffer. The finished transfer is decoded and analyzed
+# by CoE199_nus_v9 in a process pool, so the event loop only ever copies bytes and keeps serving the other devices while the
+# pipeline runs.
+#
+# The link to a device is any asyncio stream: a TCP connection from a BLE bridge, or one end of a socket pair. Commands to a
+# device end with "\n" so the other end can read them as lines, except "stop": the firmware compares it with strcmp instead
+# of strncmp, so it has to arrive as exactly "stop". It is the last command of a session and the server ends its side of
+# the link right after it, which ends the line. DeviceSimulator is the stand-in for a device. It answers the same commands in the same way as
+# received() of the firmware with the packets, footers and 1ms gaps of stream_audio() and stream_imu_data(), from a
+# synthetic recording or any int16 audio and IMU arrays, and speed scales every wait so hundreds of sessions can be tested
+# in seconds.
+#
+# With a Scheduler of CoE199_scheduler_v9 the transfers go through its bounded queue instead of straight to the pool, and
+# debug_directory also saves the debug wavs of main() for every recording as low priority work that the scheduler can shed.
+#
+# Usage:
+#   python CoE199_server_v9.py serve --port 8765 --workers 4
+#   python CoE199_server_v9.py simulate --devices 200 --speed 50
+#   python CoE199_server_v9.py simulate --devices 20 --transport tcp --speed 10
+
+import CoE199_nus_v9 as nus
+
+record_seconds = 20                                             # MIC_RECORD_DURATION_SECONDS
+chunk_size = 100                                                # CHUNK_SIZE, samples of int16 in one packet
+packet_size = chunk_size * 2                                    # bytes of one packet
+packet_gap = 0.001                                              # k_sleep(K_MSEC(1)) after every packet
+
+# This part is for the result of one recording
+# latency is the time from the last byte of the transfer to the rates, received is the size of the transfer in bytes
+class SessionResult:
+    __slots__ = ('device', 'heart_rate', 'respiratory_rate', 'received', 'latency', 'error')
+
+    def __init__(self, device, heart_rate, respiratory_rate, received, latency, error = None):
+        self.device = device
+        self.heart_rate = heart_rate
+        self.respiratory_rate = respiratory_rate
+        self.received = received
+        self.latency = latency
+        self.error = error
+
+    def __repr__(self):
+        if self.error is not None:
+            return f'SessionResult({self.device}, error={self.error})'
+        return (f'SessionResult({self.device}, heart_rate={self.heart_rate:.2f}, respiratory_rate={self.respiratory_rate:.2f}, '
+                f'latency={self.latency*1e3:.1f}ms)')
+
+# This part is for analyzing a transfer inside a worker
+# Returns the rates, or the error as text so that one bad transfer does not take down the pool. A transfer that fails the
+# signal quality check of CoE199_quality_v9 is answered without running the pipeline.
+import CoE199_quality_v9 as quality
+def analyze_transfer(payload, default = 0):
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            heartrate, respiratoryrate, verdict = quality.analyze_payload(payload, default)
+        if not verdict.passed:
+            return None, None, f'poor signal quality: {verdict}'
+        return float(heartrate), float(respiratoryrate), None
+    except Exception as error:
+        return None, None, f'{type(error).__name__}: {error}'
+
+# This part is for the debug artifacts of a transfer
+# The same wavs the script part of CoE199_main_v9 saves, named after the device and the recording
+import CoE199_main_v9 as backend
+def debug_artifacts(payload, directory, name):
+    data, samplerate, time = nus.to_pipeline(nus.decode(payload))
+    with contextlib.redirect_stdout(io.StringIO()):
+        r = backend.analyze(data, samplerate, time, full_decomposition=True)
+    hr_denoised = backend.pywt.waverec(r['hr_denoised_coefficients'], backend.wavelet)
+    rr_denoised = backend.pywt.waverec(r['rr_denoised_coefficients'], backend.wavelet)
+    for prefix, wave in (("[HR1 Filtered] ", r['hr_filtered_input']), ("[HR2 Denoised] ", hr_denoised), ("[HR3 Level 5] ", r['level5_wave']),
+                         ("[RR1 Filtered] ", r['rr_filtered_input']), ("[RR2 Denoised] ", rr_denoised), ("[RR3 Level 7] ", r['level7_wave'])):
+        # soundfile clips float samples outside [-1, 1], the bands of the raw ADC samples are scaled to their peak first
+        backend.save_to_wav(wave / (np.max(np.abs(wave)) or 1), os.path.join(directory, prefix + name + ".wav"), samplerate)
+
+# This part is for reading one transfer
+# Only the bytes that arrived since the last read are searched for the footers. The search starts one footer length back
+# and on an even offset, since find_footer only accepts footers on a sample boundary.
+async def read_transfer(reader, timeout = None):
+    payload = bytearray()
+    imu_start = None
+    searched = 0
+    while True:
+        chunk = await asyncio.wait_for(reader.read(65536), timeout)
+        if not chunk:
+            raise ConnectionError("device disconnected during the transfer")
+        payload += chunk
+
+        if imu_start is None:
+            start = max(0, searched - len(nus.audio_footer)) & ~1
+            index = nus.find_footer(payload, nus.audio_footer, start)
+            if index < 0:
+                searched = len(payload)
+                continue
+            imu_start = index + len(nus.audio_footer)
+            searched = imu_start
+
+        start = imu_start + ((max(imu_start, searched - len(nus.imu_footer)) - imu_start) & ~1)
+        index = nus.find_footer(payload, nus.imu_footer, start)
+        if index >= 0:
+            return bytes(payload[:index + len(nus.imu_footer)])
+        searched = len(payload)
+
+# This part is for the server
+# executor - pool the transfers are analyzed in, a ProcessPoolExecutor of workers processes is made when it is None. Its
+#            workers run backend.warm_up first, so the first transfer of every worker is not slowed down by the imports
+# recordings - recordings per session before the device is released, None keeps recording until the device disconnects
+# timeout - seconds without any byte from a device before its session is dropped
+# on_result - optional callback that gets every SessionResult on the event loop
+# scheduler - optional Scheduler of CoE199_scheduler_v9 that queues the transfers in front of the pool
+# debug_directory - saves the debug wavs of every recording there when it is set
+class IngestionServer:
+    def __init__(self, executor = None, workers = None, record_seconds = record_seconds, recordings = 1, default = 0,
+                 timeout = 60, on_result = None, scheduler = None, debug_directory = None):
+        if executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1, initializer=backend.warm_up)
+        self.executor = executor
+        self.record_seconds = record_seconds
+        self.recordings = recordings
+        self.default = default
+        self.timeout = timeout
+        self.on_result = on_result
+        self.scheduler = scheduler
+        self.debug_directory = debug_directory
+        self.debug_tasks = set()
+        self.results = []
+        self.active = 0
+        self.server = None
+        self.devices = 0
+
+    async def dispatch(self, device, payload):
+        # Runs the pipeline on a finished transfer without blocking the event loop
+        if self.scheduler is not None:
+            return await self.scheduler.submit(device, analyze_transfer, payload, self.default)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, analyze_transfer, payload, self.default)
+
+    async def save_debug(self, device, payload, name):
+        # Debug wavs never hold back a session, and a shed or failed export only loses the wavs
+        try:
+            if self.scheduler is not None:
+                import CoE199_scheduler_v9 as scheduler
+                await self.scheduler.submit(device, debug_artifacts, payload, self.debug_directory, name, priority=scheduler.debug)
+            else:
+                await asyncio.get_running_loop().run_in_executor(self.executor, debug_artifacts, payload, self.debug_directory, name)
+        except Exception:
+            pass
+
+    async def record(self, device, reader, writer):
+        writer.write(b"rec\n")
+        await writer.drain()
+        await asyncio.sleep(self.record_seconds)
+        writer.write(b"send\n")
+        await writer.drain()
+        payload = await read_transfer(reader, self.timeout)
+
+        finished = t.perf_counter()
+        heartrate, respiratoryrate, error = await self.dispatch(device, payload)
+        result = SessionResult(device, heartrate, respiratoryrate, len(payload), t.perf_counter() - finished, error)
+        self.results.append(result)
+        if self.on_result is not None:
+            self.on_result(result)
+
+        if self.debug_directory is not None:
+            name = f'{device} {sum(1 for r in self.results if r.device == device)}'.replace(":", "_")
+            task = asyncio.create_task(self.save_debug(device, payload, name))
+            self.debug_tasks.add(task)
+            task.add_done_callback(self.debug_tasks.discard)
+        return result
+
+    async def handle_device(self, reader, writer, device = None):
+        if device is None:
+            self.devices += 1
+            peer = writer.get_extra_info('peername')
+            device = f'{peer[0]}:{peer[1]}' if isinstance(peer, tuple) else f'device-{self.devices}'
+        self.active += 1
+        try:
+            count = 0
+            while self.recordings is None or count < self.recordings:
+                await self.record(device, reader, writer)
+                count += 1
+            writer.write(b"stop")
+            # write_eof shuts the socket down for writing even when forked pool workers still hold a copy of it, which
+            # close() alone does not
+            if writer.can_write_eof():
+                writer.write_eof()
+            await writer.drain()
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError) as error:
+            result = SessionResult(device, None, None, 0, None, f'{type(error).__name__}: {error}')
+            self.results.append(result)
+            if self.on_result is not None:
+                self.on_result(result)
+        finally:
+            self.active -= 1
+            writer.close()
+
+    async def start(self, host = "127.0.0.1", port = 8765):
+        self.server = await asyncio.start_server(self.handle_device, host, port)
+        return self.server
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.debug_tasks:
+            await asyncio.gather(*self.debug_tasks)
+        self.executor.shutdown(wait=True)
+
+# This part is for the device stand-in
+# audio and imu are the int16 samples a device would have in electret_buf and imu_buf. speed divides every wait, the
+# recording time included, and speed=None skips the waits and only yields to the event loop between packets. stopped is set
+# when the device got "stop", unknown keeps every command the firmware would have answered with "Unknown Command!".
+class DeviceSimulator:
+    def __init__(self, audio, imu = None, record_seconds = record_seconds, speed = 1):
+        self.audio = np.asarray(audio, dtype='<i2').tobytes()
+        self.imu = np.asarray(imu if imu is not None else [], dtype='<i2').tobytes()
+        self.record_seconds = record_seconds
+        self.speed = speed
+        self.recorded = False
+        self.stopped = False
+        self.unknown = []
+
+    async def wait(self, seconds):
+        await asyncio.sleep(0 if self.speed is None else seconds / self.speed)
+
+    async def send_packets(self, writer, payload, footer):
+        for offset in range(0, len(payload), packet_size):
+            writer.write(payload[offset:offset + packet_size])
+            await writer.drain()
+            await self.wait(packet_gap)
+        writer.write(footer)
+        await writer.drain()
+
+    async def run(self, reader, writer):
+        # Answers commands until "stop" or until the server closes the link
+        try:
+            while True:
+                command = await reader.readline()
+                if not command:
+                    break
+                if command.startswith(b"rec"):
+                    await self.wait(self.record_seconds)
+                    self.recorded = True
+                elif command.startswith(b"send"):
+                    await self.send_packets(writer, self.audio, nus.audio_footer)
+                    await self.send_packets(writer, self.imu, nus.imu_footer)
+                elif command.startswith(b"imu"):
+                    await self.send_packets(writer, self.imu, nus.imu_footer)
+                elif command == b"stop":
+                    # strcmp in the firmware, "stop\n" is an unknown command
+                    self.stopped = True
+                    break
+                else:
+                    self.unknown.append(command)
+                    writer.write(b"Unknown Command!\n")
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+def synthetic_device(heart_rate = 72, respiratory_rate = 16, record_seconds = record_seconds, speed = 1, seed = 0):
+    # Synthetic 12-bit ADC samples and a resting IMU magnitude of about 9.81 m/s^2 stored like imu_buf
+    import CoE199_synthetic_v9 as synthetic
+    audio, samplerate = synthetic.generate(record_seconds, nus.audio_samplerate, heart_rate, respiratory_rate, seed=seed)
+    rng = np.random.default_rng(seed)
+    imu = np.round(nus.imu_scale * (9.81 + 0.05*rng.standard_normal(int(record_seconds*nus.imu_samplerate))))
+    return DeviceSimulator(audio, imu, record_seconds, speed)
+
+# This part is for connecting simulated devices to a server
+# transport 'socketpair' links every device to the server directly, 'tcp' goes through a listening socket on localhost
+async def simulate(server, devices, transport = 'socketpair', host = "127.0.0.1", port = 0):
+    tasks = []
+    if transport == 'tcp':
+        listener = await server.start(host, port)
+        port = listener.sockets[0].getsockname()[1]
+        for device in devices:
+            reader, writer = await asyncio.open_connection(host, port)
+            tasks.append(asyncio.create_task(device.run(reader, writer)))
+    else:
+        for number, device in enumerate(devices):
+            server_side, device_side = socket.socketpair()
+            server_reader, server_writer = await asyncio.open_connection(sock=server_side)
+            device_reader, device_writer = await asyncio.open_connection(sock=device_side)
+            tasks.append(asyncio.create_task(server.handle_device(server_reader, server_writer, f'device-{number}')))
+            tasks.append(asyncio.create_task(device.run(device_reader, device_writer)))
+    await asyncio.gather(*tasks)
+    if transport == 'tcp':
+        # The device side ends first, the server sessions finish right after it
+        while server.active:
+            await asyncio.sleep(0.01)
+    return server.results
+
+async def run_simulation(n_devices = 100, transport = 'socketpair', speed = None, workers = None, record = record_seconds,
+                         recordings = 1):
+    speed_factor = speed if speed is not None else float('inf')
+    server = IngestionServer(workers=workers, record_seconds=record/speed_factor, recordings=recordings)
+    # A few different rates so that a mix-up between sessions would show up in the results
+    devices = [synthetic_device(60 + 5*(d % 7), 12 + (d % 5), record, speed, seed=d) for d in range(n_devices)]
+    try:
+        return await simulate(server, devices, transport)
+    finally:
+        await server.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Ingest recordings from many wearables and analyze them with the v9 backend")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="listen for devices on TCP")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    simulate_parser = commands.add_parser("simulate", help="run simulated devices against a local server")
+    simulate_parser.add_argument("--devices", type=int, default=100)
+    simulate_parser.add_argument("--transport", default="socketpair", choices=["socketpair", "tcp"])
+    simulate_parser.add_argument("--speed", type=float, default=None, help="divides the recording time and packet gaps, none skips them")
+    simulate_parser.add_argument("--recordings", type=int, default=1, help="recordings per device")
+    for command in (serve, simulate_parser):
+        command.add_argument("--workers", type=int, default=None, help="number of processes, defaults to every core")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        async def serve_forever():
+            server = IngestionServer(workers=args.workers, recordings=None, on_result=print)
+            listener = await server.start(args.host, args.port)
+            print(f'Listening on {args.host}:{args.port}')
+            async with listener:
+                await listener.serve_forever()
+        asyncio.run(serve_forever())
+    else:
+        start = t.perf_counter()
+        results = asyncio.run(run_simulation(args.devices, args.transport, args.speed, args.workers, recordings=args.recordings))
+        latencies = np.array([result.latency for result in results if result.error is None])
+        failed = sum(1 for result in results if result.error is not None)
+        print(f'{len(results)} recordings from {args.devices} devices ({failed} failed) in {t.perf_counter() - start:.2f}s')
+        if latencies.size:
+            print(f'Latency after the transfer: median {np.median(latencies)*1e3:.1f}ms, p95 {np.percentile(latencies, 95)*1e3:.1f}ms, '
+                  f'max {latencies.max()*1e3:.1f}ms')
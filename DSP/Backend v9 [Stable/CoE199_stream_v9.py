@@ -0,0 +1,129 @@
+import numpy as np
+import io
+import contextlib
+
+# This is the real-time streaming analyzer of the v9 backend
+# The firmware's stream_audio() sends the 2kHz int16 ADC samples in chunks of 100 samples (200 bytes). Instead of waiting
+# for the whole 20s recording, StreamingAnalyzer takes the chunks as they arrive, keeps only the last window seconds in a
+# ring buffer and runs the v9 pipeline (analyze in CoE199_main_v9) over that buffer every update_every seconds of audio.
+#
+# Memory: one ring buffer of window*samplerate samples, independent of how long the stream runs.
+# Latency: a sample is part of a published estimate at most update_every seconds plus one chunk (50ms at 100 samples and
+#   2kHz) after it was recorded, plus the time of one analysis of the window (about 15ms for 20s on a single core). Every
+#   estimate covers the last window seconds, so it describes the vitals around window/2 seconds before it was published.
+#
+# Usage:
+#   analyzer = StreamingAnalyzer(on_update=lambda estimate: print(estimate))
+#   for packet in packets:          # 200 byte NUS payloads
+#       analyzer.push(packet)
+
+import CoE199_main_v9 as backend
+import CoE199_nus_v9 as nus
+
+# This part is for a published estimate
+# time is the stream time in seconds of the newest sample that went into the estimate
+class Estimate:
+    __slots__ = ('time', 'heart_rate', 'respiratory_rate', 'window')
+
+    def __init__(self, time, heart_rate, respiratory_rate, window):
+        self.time = time
+        self.heart_rate = heart_rate
+        self.respiratory_rate = respiratory_rate
+        self.window = window
+
+    def __repr__(self):
+        return f'Estimate(time={self.time:.2f}s, heart_rate={self.heart_rate:.2f}, respiratory_rate={self.respiratory_rate:.2f}, window={self.window:.1f}s)'
+
+class StreamingAnalyzer:
+    def __init__(self, samplerate = 2000, window = 20, update_every = 2, minimum = 10, default = 0, on_update = None):
+        # window - seconds of audio that every estimate covers
+        # update_every - seconds of new audio between two estimates
+        # minimum - seconds of audio needed before the first estimate
+        # on_update - optional callback that gets every new Estimate
+        self.samplerate = samplerate
+        self.window = window
+        self.update_every = update_every
+        self.minimum = min(minimum, window)
+        self.default = default
+        self.on_update = on_update
+
+        self.buffer = np.zeros(int(window*samplerate))
+        self.position = 0                                       # next write index of the ring buffer
+        self.received = 0                                       # samples received since the start of the stream
+        self.next_update = int(self.minimum*samplerate)
+        self.pending = b''                                      # odd byte left over from a packet
+        self.last_sample = None
+        self.estimate = None
+
+    # This part is for turning a chunk into samples
+    # Chunks can be raw little-endian int16 bytes from the NUS packets or any array of samples
+    def samples(self, chunk):
+        if isinstance(chunk, (bytes, bytearray, memoryview)):
+            chunk = self.pending + bytes(chunk)
+            usable = len(chunk) - len(chunk) % 2
+            self.pending = chunk[usable:]
+            chunk = np.frombuffer(chunk[:usable], dtype='<i2')
+
+        # The firmware writes -1 when an ADC read fails, the previous sample is held instead of feeding a spike to the filters.
+        # Only the raw int16 samples can hold a failed read, -1.0 in a float chunk is a sample like any other.
+        chunk = np.asarray(chunk)
+        if chunk.dtype == np.int16:
+            chunk = nus.hold_failed(chunk, previous=self.last_sample)
+        else:
+            chunk = chunk.astype(np.float64, copy=False)
+        if chunk.size:
+            self.last_sample = chunk[-1]
+        return chunk
+
+    def write(self, chunk):
+        # Only the newest window of a chunk larger than the buffer is kept
+        chunk = chunk[-self.buffer.size:]
+        end = self.position + chunk.size
+        if end <= self.buffer.size:
+            self.buffer[self.position:end] = chunk
+        else:
+            split = self.buffer.size - self.position
+            self.buffer[self.position:] = chunk[:split]
+            self.buffer[:end - self.buffer.size] = chunk[split:]
+        self.position = end % self.buffer.size
+
+    # This part is for the samples of the current window in recording order
+    def current_window(self):
+        filled = min(self.received, self.buffer.size)
+        if filled < self.buffer.size:
+            return self.buffer[:filled]
+        return np.concatenate((self.buffer[self.position:], self.buffer[:self.position]))
+
+    def push(self, chunk):
+        # Returns the new Estimate when this chunk completes an update interval, otherwise None
+        chunk = self.samples(chunk)
+        if chunk.size == 0:
+            return None
+        self.write(chunk)
+        self.received += chunk.size
+
+        if self.received < self.next_update:
+            return None
+        self.next_update = self.received + int(self.update_every*self.samplerate)
+        return self.update()
+
+    def update(self):
+        data = self.current_window()
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = backend.analyze(data, self.samplerate, default=self.default)
+        self.estimate = Estimate(self.received/self.samplerate, results['heartrate'], results['respiratoryrate'], data.size/self.samplerate)
+        if self.on_update is not None:
+            self.on_update(self.estimate)
+        return self.estimate
+
+if __name__ == "__main__":
+    # Replays a synthetic recording in the firmware's 100 sample chunks and prints every estimate
+    import time as t
+    import CoE199_synthetic_v9 as synthetic
+    data, samplerate = synthetic.generate(60, heart_rate=72, respiratory_rate=16)
+    packets = data.astype('<i2').tobytes()
+    analyzer = StreamingAnalyzer(samplerate, on_update=print)
+    start = t.perf_counter()
+    for offset in range(0, len(packets), 200):
+        analyzer.push(packets[offset:offset+200])
+    print(f'Processed {len(data)/samplerate:.0f}s of audio in {t.perf_counter() - start:.2f}s')
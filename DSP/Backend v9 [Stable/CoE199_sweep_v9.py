@@ -0,0 +1,191 @@
+import os
+import io
+import csv
+import contextlib
+import itertools
+import warnings
+import time as t
+import numpy as np
+
+# This is the parameter sweep of the peak detectors of the v9 backend
+# The constants of the detectors were tuned by hand between v7 and v9: the 2x and 10x moving average thresholds, the 0.5s
+# moving average window and the z-score limit of 3 of the heart rate peaks, the 0.1s refractory distance after a heart rate
+# peak, and the 0.5s area window and 1s peak distance of the respiratory peaks. The sweep runs the filters, the wavelets and
+# the envelopes of every recording once, then scores every combination of a grid of these constants against the reference
+# heart rate and respiratory rate of the recording. The recordings are spread over a process pool, every worker keeps its
+# envelopes to itself and only sends back one rate and one time per setting.
+#
+# Inside a worker the settings share what they can: the threshold candidates are found once per (lower, upper, window) and
+# reused by every (z_limit, refractory), and the area is computed once per window and reused by every distance. The runtime
+# of a setting is still the time the detector would take with that setting alone, the shared part is added to every setting
+# that uses it.
+#
+# The labels are a csv with the columns file, heart_rate and respiratory_rate, the files are relative to the csv.
+#
+# Usage:
+#   python CoE199_sweep_v9.py labels.csv sweep.csv
+#   python CoE199_sweep_v9.py labels.csv sweep.csv --lower 1.5 2 2.5 --z-limit 2 3 4 --distance 0.8 1 1.5 --workers 8
+
+import CoE199_main_v9 as backend
+
+# These are the default grids, the first value of every grid is the constant the backend uses
+hr_grid = {
+    'lower': [2, 1.5, 2.5, 3],
+    'upper': [10, 6, 8, 15],
+    'window': [0.5, 0.25, 1],
+    'z_limit': [3, 2, 2.5, 4],
+    'refractory': [0.1, 0.05, 0.2, 0.3],
+}
+rr_grid = {
+    'area_window': [0.5, 0.25, 1],
+    'distance': [1, 0.5, 1.5, 2],
+}
+columns = ['branch'] + list(hr_grid) + list(rr_grid) + ['mae', 'failed', 'runtime_ms']
+
+def settings(grid):
+    # Every combination of the grid as a dict, in the order of the grid
+    return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+# This part is for the labels
+def load_labels(filename):
+    directory = os.path.dirname(os.path.abspath(filename))
+    labels = []
+    with open(filename, newline="") as file:
+        for row in csv.DictReader(file):
+            labels.append((os.path.join(directory, row['file']), float(row['heart_rate']), float(row['respiratory_rate'])))
+    return labels
+
+# This part is for one setting of a detector
+# A setting that does not give a rate, like one that accepts fewer than two peaks, gives NaN and counts as failed
+def quiet_rate(function, *args):
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings(), np.errstate(all='ignore'):
+        warnings.simplefilter('ignore')
+        try:
+            rate = float(function(*args))
+        except Exception:
+            return np.nan
+    return rate if np.isfinite(rate) else np.nan
+
+def heart_rate(envelope, candidates, samplerate, z_limit, refractory, default):
+    tracker = backend.HrPeakTracker(samplerate, compiled=False, z_limit=z_limit, refractory=refractory)
+    peaks = tracker.update(candidates)
+    return backend.heart_rate_from_peaks(envelope, peaks, samplerate, default)
+
+def respiratory_rate(areas, time, samplerate, distance):
+    return backend.rr_peaks_from_area(areas, time, samplerate, 1, distance)[0]
+
+# This part is for sweeping one recording inside a worker
+# Returns the heart rates and respiratory rates of every setting with their runtime in ms, in the order of settings()
+def sweep_recording(path, hr_grid = hr_grid, rr_grid = rr_grid, default = 0, precision = 'float64'):
+    try:
+        data, samplerate, _ = backend.wav_to_array(path)
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = backend.analyze(data, samplerate, default=default, precision=precision)
+    except Exception:
+        return None
+    time = results['time']
+    hr_envelope = np.asarray(results['hr_envelope'], dtype=np.float64)
+    rr_envelope = results['rr_envelope']
+
+    hr_rows = []
+    candidates = {}
+    for setting in settings(hr_grid):
+        key = (setting['lower'], setting['upper'], setting['window'])
+        if key not in candidates:
+            start = t.perf_counter_ns()
+            found = backend.hr_threshold_candidates(hr_envelope, samplerate, *key)
+            candidates[key] = found, t.perf_counter_ns() - start
+        found, shared = candidates[key]
+        start = t.perf_counter_ns()
+        rate = quiet_rate(heart_rate, hr_envelope, found, samplerate, setting['z_limit'], setting['refractory'], default)
+        hr_rows.append((rate, (t.perf_counter_ns() - start + shared) / 1e6))
+
+    rr_rows = []
+    areas = {}
+    for setting in settings(rr_grid):
+        key = setting['area_window']
+        if key not in areas:
+            start = t.perf_counter_ns()
+            area = backend.normalized_area(rr_envelope, samplerate, key)
+            areas[key] = area, t.perf_counter_ns() - start
+        area, shared = areas[key]
+        start = t.perf_counter_ns()
+        rate = quiet_rate(respiratory_rate, area, time, samplerate, setting['distance'])
+        rr_rows.append((rate, (t.perf_counter_ns() - start + shared) / 1e6))
+    return hr_rows, rr_rows
+
+def sweep_recording_args(args):
+    return sweep_recording(*args)
+
+# This part is for scoring the settings over every recording
+# A recording that cannot be read counts as failed for every setting
+def score(grid, branch, rates, runtimes, reference):
+    rows = []
+    errors = np.abs(rates - reference[:, None])
+    for s, setting in enumerate(settings(grid)):
+        valid = np.isfinite(errors[:, s])
+        row = dict.fromkeys(columns)
+        row['branch'] = branch
+        row.update(setting)
+        row['mae'] = float(np.mean(errors[valid, s])) if valid.any() else np.nan
+        row['failed'] = int(np.count_nonzero(~valid))
+        row['runtime_ms'] = float(np.nanmean(runtimes[:, s])) if np.isfinite(runtimes[:, s]).any() else np.nan
+        rows.append(row)
+    # Best first, the settings without any rate go last
+    rows.sort(key=lambda row: (np.isnan(row['mae']), row['mae'] if not np.isnan(row['mae']) else 0))
+    return rows
+
+from concurrent.futures import ProcessPoolExecutor
+def run_sweep(labels, output = None, hr_grid = hr_grid, rr_grid = rr_grid, workers = None, default = 0, precision = 'float64'):
+    if isinstance(labels, str):
+        labels = load_labels(labels)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # Every worker is warmed up first, so the runtime of the settings on its first recording has no imports in it
+    tasks = [(path, hr_grid, rr_grid, default, precision) for path, _, _ in labels]
+    if workers == 1 or len(tasks) <= 1:
+        backend.warm_up()
+        results = [sweep_recording_args(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=backend.warm_up) as executor:
+            results = list(executor.map(sweep_recording_args, tasks))
+
+    rows = []
+    for branch, grid, index, reference in (('hr', hr_grid, 0, [hr for _, hr, _ in labels]),
+                                           ('rr', rr_grid, 1, [rr for _, _, rr in labels])):
+        n_settings = len(settings(grid))
+        rates = np.full((len(labels), n_settings), np.nan)
+        runtimes = np.full((len(labels), n_settings), np.nan)
+        for r, result in enumerate(results):
+            if result is not None:
+                rates[r], runtimes[r] = np.array(result[index]).T
+        rows += score(grid, branch, rates, runtimes, np.array(reference, dtype=np.float64))
+
+    if output is not None:
+        with open(output, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Score a grid of peak detector constants against reference heart and respiratory rates")
+    parser.add_argument("labels", help="csv with the columns file, heart_rate and respiratory_rate")
+    parser.add_argument("output", help="csv of the mean absolute error and runtime of every setting, best first")
+    for name, values in list(hr_grid.items()) + list(rr_grid.items()):
+        parser.add_argument("--" + name.replace("_", "-"), type=float, nargs="+", default=values)
+    parser.add_argument("--workers", type=int, default=None, help="number of processes, defaults to every core")
+    parser.add_argument("--default", type=int, default=0, help="heart rate mode of main, 0 auto, 1 S-S, 2 P-P")
+    parser.add_argument("--precision", default="float64", choices=["float64", "float32"])
+    args = parser.parse_args()
+
+    start = t.perf_counter()
+    rows = run_sweep(args.labels, args.output, {name: getattr(args, name) for name in hr_grid},
+                     {name: getattr(args, name) for name in rr_grid}, args.workers, args.default, args.precision)
+    for branch in ('hr', 'rr'):
+        best = next(row for row in rows if row['branch'] == branch)
+        setting = ', '.join(f'{name}={best[name]:g}' for name in (hr_grid if branch == 'hr' else rr_grid))
+        print(f'Best {branch.upper()}: {setting}\tMAE {best["mae"]:.2f}\t{best["runtime_ms"]:.2f} ms')
+    print(f'Swept {len(rows)} settings in {t.perf_counter() - start:.2f}s -> {args.output}')
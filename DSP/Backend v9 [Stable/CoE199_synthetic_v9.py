@@ -0,0 +1,78 @@
+import numpy as np
+import scipy.signal as signal
+
+# This is the synthetic heart and lung sound generator
+# It builds recordings with a known heart rate and respiratory rate so that the speed and the accuracy of the backend can be
+# checked together without real recordings.
+#   - Every heartbeat has an S1 and an S2 sound, short tone bursts in the 30-60Hz band that the level 5 wavelet band keeps
+#   - Every breath has an inhale and an exhale burst of 125-250Hz noise, the band that the level 7 wavelet band keeps
+#   - Heart and breath timing jitter and background noise make the detectors work for their answer
+# The output is scaled like the firmware ADC, a 12-bit value around the 2048 mid-scale, unless scale is None.
+
+# This part is for a single heart sound
+def heart_sound(samplerate, frequency, duration):
+    n = int(samplerate*duration)
+    i = np.arange(n) / samplerate
+    return np.hanning(n) * np.sin(2*np.pi*frequency*i)
+
+# This part is for placing a sound at every event position
+# The positions are in samples, a sound that would run past the end of the recording is cut
+def place_events(data, sound, positions):
+    for position in positions:
+        end = min(position + sound.size, data.size)
+        if position < end:
+            data[position:end] += sound[:end-position]
+    return data
+
+# This part is for the heart sounds
+# S2 follows S1 after the systolic interval, which shortens as the heart rate goes up
+def heart_sounds(n_samples, samplerate, heart_rate, jitter, rng):
+    data = np.zeros(n_samples)
+    period = 60 / heart_rate
+    n_beats = int(n_samples / samplerate / period) + 2
+    beats = 0.25 + np.cumsum(np.full(n_beats, period) * (1 + jitter*rng.standard_normal(n_beats))) - period
+    systole = 0.42 * period**0.5 - 0.05
+
+    s1 = heart_sound(samplerate, 40, 0.07)
+    s2 = heart_sound(samplerate, 55, 0.06) * 0.6
+    place_events(data, s1, (beats * samplerate).astype(int))
+    place_events(data, s2, ((beats + systole) * samplerate).astype(int))
+    return data
+
+# This part is for the breath sounds
+# Inhale takes the first 40% of every breath and exhale runs from 50% to 90%, with silence in between so that the area of
+# the envelope goes back down between the two
+def breath_sounds(n_samples, samplerate, respiratory_rate, jitter, rng):
+    period = 60 / respiratory_rate
+    n_breaths = int(n_samples / samplerate / period) + 2
+    starts = 0.5 + np.cumsum(np.full(n_breaths, period) * (1 + jitter*rng.standard_normal(n_breaths))) - period
+
+    modulation = np.zeros(n_samples)
+    inhale = np.hanning(int(samplerate*period*0.4))
+    exhale = np.hanning(int(samplerate*period*0.4)) * 0.7
+    place_events(modulation, inhale, (starts * samplerate).astype(int))
+    place_events(modulation, exhale, ((starts + period*0.5) * samplerate).astype(int))
+
+    sos = signal.butter(4, [125, 250], btype='band', output='sos', fs=samplerate)
+    noise = signal.sosfilt(sos, rng.standard_normal(n_samples))
+    return modulation * noise / np.std(noise)
+
+def generate(duration = 20, samplerate = 2000, heart_rate = 72, respiratory_rate = 16, breath_level = 0.5, noise_level = 0.1,
+             jitter = 0.02, seed = 0, scale = 2047):
+    rng = np.random.default_rng(seed)
+    n_samples = int(duration*samplerate)
+
+    data = heart_sounds(n_samples, samplerate, heart_rate, jitter, rng)
+    data += breath_level * breath_sounds(n_samples, samplerate, respiratory_rate, jitter, rng)
+    data += noise_level * rng.standard_normal(n_samples)
+
+    if scale is not None:
+        data = np.clip(np.round(2048 + data / np.max(np.abs(data)) * scale * 0.8), 0, 4095)
+    return data, samplerate
+
+# This part is for writing a synthetic recording as a wav file that wav_to_array can read
+import soundfile as sf
+def save_synthetic(filename, duration = 20, samplerate = 2000, heart_rate = 72, respiratory_rate = 16, **kwargs):
+    data, samplerate = generate(duration, samplerate, heart_rate, respiratory_rate, scale=None, **kwargs)
+    sf.write(filename, 0.9 * data / np.max(np.abs(data)), samplerate, subtype='PCM_16')
+    return filename
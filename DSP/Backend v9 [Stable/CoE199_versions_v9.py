@@ -0,0 +1,253 @@
+import os
+import io
+import ast
+import csv
+import types
+import contextlib
+import time as t
+import numpy as np
+
+# This is the cross-version harness of the backend
+# Every backend from v1 to v9 is loaded as an engine and run on the same labelled recordings, and every run gets the heart
+# rate and respiratory rate errors against the labels and the time of every stage. A new revision can be checked against
+# the ones before it for accuracy and speed before it is deployed (see DSP/revision.txt for what changed in each one).
+#
+# The old backends are scripts: v1 to v5 call main() on a fixed file when they are imported, and the later ones keep their
+# plots and wav exports under __main__. A version is loaded by parsing its source and dropping the top level calls and the
+# __main__ block before running it in a new module, so none of its own files are read or written. An engine then runs the
+# stages of that version in the order its main() ran them, with a StageTimer lap after every stage, so the stage columns are
+# the same for every version. Whatever a version prints is discarded, but the time it spends printing is still counted.
+#
+# Engines are plain functions engine(data, samplerate, default, timings) that return (heart_rate, respiratory_rate), v1 and
+# v2 have no respiratory rate and return NaN for it. v1 keeps its peaks in a list of 10s of samples, so it fails on anything
+# longer, which shows up as an error in its rows. More engines can be added with register_engine before run_versions, as
+# long as they are registered at import time so the worker processes see them too.
+#
+# The labels are a csv with the columns file, heart_rate and respiratory_rate like in CoE199_sweep_v9.
+#
+# Usage:
+#   python CoE199_versions_v9.py labels.csv versions.csv
+#   python CoE199_versions_v9.py labels.csv versions.csv --engines v7 v9 --workers 8 --default 1
+
+import CoE199_main_v9 as backend
+import CoE199_sweep_v9 as sweep
+
+dsp_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+stages = ['wav_to_array', 'bandpass_filter', 'hr_denoising', 'hr_reconstruction', 'hr_extract_features', 'hr_peak_detection',
+          'rr_denoising', 'rr_reconstruction', 'rr_extract_features', 'rr_peak_detection']
+columns = ['engine', 'file', 'heart_rate', 'respiratory_rate', 'hr_error', 'rr_error'] + [f'{stage}_ms' for stage in stages] + ['total_ms', 'error']
+
+# This part is for the old backends
+# filter: None when the version has no bandpass filter, 'shared' when one 10-950Hz filter feeds both branches (v4), 'split'
+#   when each branch has its own band (v5 onwards)
+# hr_detector: name of the heart rate peak detector, v1 and v2 called it peak_detection
+# rr: False for the versions without respiratory rate
+# hr_default: True when the heart rate detector takes the heart rate mode of main (v7 onwards)
+# rr_default: mode that main() passed to the respiratory rate detector, None when it takes no mode
+versions = {
+    'v1': ("Backend v1.0 [Stable]/CoE199_main.py", dict(filter=None, hr_detector='peak_detection', rr=False, hr_default=False, rr_default=None)),
+    'v2': ("Backend v2 [Stable]/CoE199_main_v2.py", dict(filter=None, hr_detector='peak_detection', rr=False, hr_default=False, rr_default=None)),
+    'v3': ("Backend v3 [Stable]/CoE199_main_v3.py", dict(filter=None, hr_detector='hr_peak_detection', rr=True, hr_default=False, rr_default=None)),
+    'v4': ("Backend v4 [Stable]/CoE199_main_v4.py", dict(filter='shared', hr_detector='hr_peak_detection', rr=True, hr_default=False, rr_default=None)),
+    'v5': ("Backend v5 [Stable]/CoE199_main_v5.py", dict(filter='split', hr_detector='hr_peak_detection', rr=True, hr_default=False, rr_default=None)),
+    'v6': ("Backend v6 [Stable]/CoE199_main_v6.py", dict(filter='split', hr_detector='hr_peak_detection', rr=True, hr_default=False, rr_default=None)),
+    'v7': ("Backend v7 [Stable]/CoE199_main_v7.py", dict(filter='split', hr_detector='hr_peak_detection', rr=True, hr_default=True, rr_default=None)),
+    'v9_clean': ("Backend v9 [Stable/CoE199_main_v9_clean.py", dict(filter='split', hr_detector='hr_peak_detection', rr=True, hr_default=True, rr_default=1)),
+}
+
+# This part is for loading a version without running its script part
+loaded = {}
+def is_script(node):
+    if isinstance(node, ast.Expr) and isinstance(node.value, ast.Call):
+        return True
+    if isinstance(node, ast.If):
+        test = ast.dump(node.test)
+        return "'__name__'" in test and "'__main__'" in test
+    return False
+
+def load_version(name):
+    if name not in loaded:
+        path = os.path.join(dsp_directory, versions[name][0])
+        with open(path) as file:
+            tree = ast.parse(file.read(), path)
+        tree.body = [node for node in tree.body if not is_script(node)]
+        # The old backends import pyplot at the top, which must not open a window inside a worker
+        os.environ.setdefault('MPLBACKEND', 'Agg')
+        module = types.ModuleType(os.path.splitext(os.path.basename(path))[0])
+        module.__file__ = path
+        exec(compile(tree, path, 'exec'), module.__dict__)
+        loaded[name] = module
+    return loaded[name]
+
+# This part is for running an old version
+# The wavelet bands are cut or padded to the length of the recording like in main() of v4 onwards, which does nothing on
+# the even lengths the older versions were written for
+def fit(wave, n):
+    if wave.size > n:
+        return wave[:n]
+    return np.pad(wave, (0, n - wave.size))
+
+def band(module, coefficients, level, n):
+    return fit(module.pywt.waverec([np.zeros_like(c) if j != level else c for j, c in enumerate(coefficients)], module.wavelet), n)
+
+def coefficients_of(module, filtered):
+    # v1 and v2 return the coefficients before and after the threshold and the denoised signal
+    coefficients = module.denoising(filtered, module.wavelet)
+    return coefficients[1] if isinstance(coefficients, tuple) else coefficients
+
+def envelope_of(module, wave):
+    # v9_clean only returns the envelope, the others return the Shannon energy first
+    features = module.extract_features(wave)
+    return features[1] if isinstance(features, tuple) else features
+
+def run_version(name, data, samplerate, default = 0, timings = None):
+    module = load_version(name)
+    spec = versions[name][1]
+    timer = backend.StageTimer(timings)
+    n = len(data)
+    time = np.linspace(0, n/samplerate, num=n)
+    hr_detector = getattr(module, spec['hr_detector'])
+    hr_mode = (default,) if spec['hr_default'] else ()
+    rr_mode = (spec['rr_default'],) if spec['rr_default'] is not None else ()
+
+    if spec['filter'] is None:
+        hr_filtered_input = rr_filtered_input = data
+    elif spec['filter'] == 'shared':
+        hr_filtered_input = rr_filtered_input = module.bandpass_filter(data, samplerate)
+    else:
+        hr_filtered_input = module.bandpass_filter(data, samplerate, 10, 200)
+        rr_filtered_input = module.bandpass_filter(data, samplerate, 100, 950)
+    timer.lap('bandpass_filter')
+
+    # Heart Rate Computations
+    hr_coefficients = coefficients_of(module, hr_filtered_input)
+    timer.lap('hr_denoising')
+    level5_wave = band(module, hr_coefficients, 5, n)
+    timer.lap('hr_reconstruction')
+    hr_envelope = envelope_of(module, level5_wave)
+    timer.lap('hr_extract_features')
+    heartrate = hr_detector(hr_envelope, time, samplerate, *hr_mode)[0]
+    timer.lap('hr_peak_detection')
+    if not spec['rr']:
+        return heartrate, np.nan
+
+    # Respiratory Rate Computations, v3 and v4 take level 7 of the same decomposition as the heart rate
+    if rr_filtered_input is hr_filtered_input:
+        rr_coefficients = hr_coefficients
+    else:
+        rr_coefficients = coefficients_of(module, rr_filtered_input)
+    timer.lap('rr_denoising')
+    level7_wave = band(module, rr_coefficients, 7, n)
+    timer.lap('rr_reconstruction')
+    rr_envelope = envelope_of(module, level7_wave)
+    timer.lap('rr_extract_features')
+    respiratoryrate = module.rr_peak_detection(rr_envelope, time, samplerate, *rr_mode)[0]
+    timer.lap('rr_peak_detection')
+    return heartrate, respiratoryrate
+
+# This part is for the engines
+def version_engine(name):
+    return lambda data, samplerate, default, timings: run_version(name, data, samplerate, default, timings)
+
+def v9_engine(data, samplerate, default, timings):
+    results = backend.analyze(data, samplerate, default=default, timings=timings)
+    return results['heartrate'], results['respiratoryrate']
+
+engines = {name: version_engine(name) for name in versions}
+engines['v9'] = v9_engine
+
+def register_engine(name, engine):
+    engines[name] = engine
+
+# This part is for one engine on one recording inside a worker
+# Every error is caught and stored in the row so that one version failing on a recording does not stop the others
+def run_engine(name, path, heart_rate, respiratory_rate, default = 0):
+    row = dict.fromkeys(columns)
+    row['engine'] = name
+    row['file'] = path
+    timings = {}
+    start = t.perf_counter_ns()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            lap = t.perf_counter_ns()
+            data, samplerate, _ = backend.wav_to_array(path)
+            timings['wav_to_array'] = t.perf_counter_ns() - lap
+            heartrate, respiratoryrate = engines[name](data, samplerate, default, timings)
+        row['heart_rate'] = float(heartrate)
+        row['respiratory_rate'] = float(respiratoryrate)
+        row['hr_error'] = abs(row['heart_rate'] - heart_rate)
+        row['rr_error'] = abs(row['respiratory_rate'] - respiratory_rate)
+    except Exception as error:
+        row['error'] = f'{type(error).__name__}: {error}'
+    row['total_ms'] = (t.perf_counter_ns() - start) / 1e6
+    for stage in stages:
+        if stage in timings:
+            row[f'{stage}_ms'] = timings[stage] / 1e6
+    return row
+
+def run_engine_args(args):
+    return run_engine(*args)
+
+# This part is for the summary of every engine
+# The means skip NaN rates and the times of the runs that failed, a NaN or inf heart rate counts as failed like an error does
+def summarize(rows, names):
+    summary = []
+    for name in names:
+        own = [row for row in rows if row['engine'] == name and row['error'] is None]
+        entry = {'engine': name, 'recordings': sum(1 for row in rows if row['engine'] == name)}
+        for column in ['hr_error', 'rr_error'] + [f'{stage}_ms' for stage in stages] + ['total_ms']:
+            values = np.array([row[column] for row in own if row[column] is not None], dtype=np.float64)
+            values = values[np.isfinite(values)]
+            entry[column] = float(np.mean(values)) if values.size else np.nan
+        entry['failed'] = entry['recordings'] - sum(1 for row in own if np.isfinite(row['heart_rate']))
+        summary.append(entry)
+    return summary
+
+def print_summary(summary):
+    print(f'{"engine":<10}{"HR MAE":>10}{"RR MAE":>10}{"failed":>8}' + ''.join(f'{stage[:14]:>16}' for stage in stages) + f'{"total":>12}')
+    for entry in summary:
+        print(f'{entry["engine"]:<10}{entry["hr_error"]:>10.2f}{entry["rr_error"]:>10.2f}{entry["failed"]:>8}'
+              + ''.join(f'{entry[stage + "_ms"]:>13.2f} ms' for stage in stages) + f'{entry["total_ms"]:>9.2f} ms')
+
+# This part is for running every engine on every recording
+# The runs are spread over a process pool, several runs per task keeps the inter-process overhead small. Every worker is
+# warmed up before its first run, so the stage columns of the first runs do not include the imports of the backend.
+from concurrent.futures import ProcessPoolExecutor
+def run_versions(labels, output = None, names = None, workers = None, default = 0):
+    if isinstance(labels, str):
+        labels = sweep.load_labels(labels)
+    if names is None:
+        names = list(engines)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    tasks = [(name, path, heart_rate, respiratory_rate, default) for name in names for path, heart_rate, respiratory_rate in labels]
+    if workers == 1 or len(tasks) <= 1:
+        backend.warm_up()
+        rows = [run_engine_args(task) for task in tasks]
+    else:
+        chunksize = max(1, len(tasks) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, initializer=backend.warm_up) as executor:
+            rows = list(executor.map(run_engine_args, tasks, chunksize=chunksize))
+
+    if output is not None:
+        with open(output, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows, summarize(rows, names)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run every backend version on the same labelled recordings and compare errors and stage times")
+    parser.add_argument("labels", help="csv with the columns file, heart_rate and respiratory_rate")
+    parser.add_argument("output", help="csv with one row per engine and recording")
+    parser.add_argument("--engines", nargs="+", default=None, choices=list(engines), help="engines to run, defaults to all of them")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes, defaults to every core")
+    parser.add_argument("--default", type=int, default=0, help="heart rate mode of v7 onwards, 0 auto, 1 S-S, 2 P-P")
+    args = parser.parse_args()
+
+    start = t.perf_counter()
+    rows, summary = run_versions(args.labels, args.output, args.engines, args.workers, args.default)
+    print_summary(summary)
+    print(f'Ran {len(summary)} engines on {len(rows) // max(1, len(summary))} recordings in {t.perf_counter() - start:.2f}s -> {args.output}')
@@ -0,0 +1,22 @@
+import io
+import os
+import sys
+import contextlib
+import warnings
+import numpy as np
+
+# The backend modules are scripts next to this folder, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import CoE199_synthetic_v9 as synthetic
+
+def quiet(function, *args, **kwargs):
+    # heart_rate_from_peaks and respiratory_rate_from_peaks print their verdicts and warn about empty intervals
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return function(*args, **kwargs)
+
+def recording(duration = 20, seed = 0, heart_rate = 72, respiratory_rate = 16, noise_level = 0.1, samplerate = 2000):
+    # A synthetic recording as floating point samples, like wav_to_array gives them
+    data, _ = synthetic.generate(duration, samplerate, heart_rate=heart_rate, respiratory_rate=respiratory_rate,
+                                 noise_level=noise_level, seed=seed, scale=None)
+    return np.asarray(data)
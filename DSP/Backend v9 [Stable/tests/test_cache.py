@@ -0,0 +1,47 @@
+import os
+import numpy as np
+
+import CoE199_main_v9 as backend
+import CoE199_cache_v9 as cache_module
+from conftest import quiet, recording
+
+# The cached pipeline has to give the rates of analyze from a cold and a warm cache, and evict must never remove the
+# entries the arrays it just returned are mapped from
+
+samplerate = 2000
+
+def test_cold_and_warm(tmp_path):
+    data = recording()
+    cache = cache_module.StageCache(str(tmp_path))
+    reference = quiet(backend.analyze, data, samplerate)
+    cold = quiet(cache_module.analyze_cached, data, samplerate, cache)
+    warm = quiet(cache_module.analyze_cached, data, samplerate, cache)
+    assert cold['hr_cached'] == [] and cold['rr_cached'] == []
+    assert warm['hr_cached'][-1] == 'hr_extract_features' and warm['rr_cached'][-1] == 'rr_area'
+    for results in (cold, warm):
+        assert results['hr_peaks'] == reference['hr_peaks']
+        assert results['rr_peaks'] == reference['rr_peaks']
+        np.testing.assert_equal(results['heartrate'], reference['heartrate'])
+        np.testing.assert_equal(results['respiratoryrate'], reference['respiratoryrate'])
+
+def test_evict_keeps_current_run(tmp_path):
+    cache = cache_module.StageCache(str(tmp_path))
+    quiet(cache_module.analyze_cached, recording(seed=0), samplerate, cache)
+    old = {path for _, _, path in cache.entries()}
+    # A limit below the size of one run has to remove every older entry and none of the new ones
+    cache.max_bytes = 1
+    quiet(cache_module.analyze_cached, recording(seed=1), samplerate, cache)
+    left = {path for _, _, path in cache.entries()}
+    assert not left & old
+    assert left == {cache.path(key) for key in cache.used}
+    assert len(left) == 9
+    # A warm run returns arrays mapped from the entries it loaded
+    results = quiet(cache_module.analyze_cached, recording(seed=1), samplerate, cache)
+    assert isinstance(results['hr_envelope'], np.memmap) and isinstance(results['rr_area'], np.memmap)
+    assert os.path.exists(results['hr_envelope'].filename) and os.path.exists(results['rr_area'].filename)
+
+def test_salt(tmp_path):
+    default = cache_module.StageCache(str(tmp_path))
+    other = cache_module.StageCache(str(tmp_path), salt=b'CoE199_v9/0')
+    assert default.key(np.arange(4), samplerate) == default.key(np.arange(4), samplerate)
+    assert default.key(np.arange(4), samplerate) != other.key(np.arange(4), samplerate)
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+import CoE199_main_v9 as backend
+import CoE199_chunked_v9 as chunked
+from conftest import quiet, recording
+
+# analyze_chunked has to find the peaks and rates of analyze on the whole recording. On a quiet recording in one block
+# they are identical. Otherwise the estimated median of the noise threshold and the envelopes of the blocks can move a few
+# heart rate peaks.
+
+samplerate = 2000
+
+@pytest.mark.parametrize('duration, heart_rate', [(60, 72), (90, 110), (120, 55)])
+def test_one_block_matches_analyze(duration, heart_rate):
+    data = recording(duration, seed=heart_rate, heart_rate=heart_rate)
+    reference = quiet(backend.analyze, data, samplerate)
+    results = quiet(chunked.analyze_chunked, data, samplerate)
+    assert results['hr_peaks'] == reference['hr_peaks']
+    assert results['rr_peaks'] == reference['rr_peaks']
+    np.testing.assert_equal(results['heartrate'], reference['heartrate'])
+    np.testing.assert_equal(results['respiratoryrate'], reference['respiratoryrate'])
+
+@pytest.mark.parametrize('seed, noise_level', [(0, 0.1), (1, 0.5), (2, 0.1), (3, 0.5)])
+@pytest.mark.parametrize('heart_rate, block, margin', [(55, 15, 3), (72, 20, 5), (110, 20, 10), (140, 120, 10)])
+def test_blocks_match_analyze(seed, noise_level, heart_rate, block, margin):
+    data = recording(90, seed=seed, heart_rate=heart_rate, noise_level=noise_level)
+    reference = quiet(backend.analyze, data, samplerate)
+    results = quiet(chunked.analyze_chunked, data, samplerate, block=block, margin=margin)
+    peaks, reference_peaks = results['hr_peaks'].indices, reference['hr_peaks'].indices
+    assert abs(peaks.size - reference_peaks.size) <= 1
+    assert np.mean(np.isin(reference_peaks, peaks)) >= 0.98
+    assert abs(results['heartrate'] - reference['heartrate']) < 1
+    assert abs(results['respiratoryrate'] - reference['respiratoryrate']) < 0.05
+
+def test_blocks_are_aligned():
+    n = 75*samplerate + 123
+    cores = []
+    for start, end, core_start, core_end in chunked.blocks(n, samplerate, block=15, margin=3):
+        assert core_start % chunked.alignment == 0 and start % chunked.alignment == 0
+        assert start <= core_start < core_end <= end <= n
+        cores.append((core_start, core_end))
+    # The cores tile the recording without gaps or overlaps
+    assert cores[0][0] == 0 and cores[-1][1] == n
+    assert all(cores[k][1] == cores[k+1][0] for k in range(len(cores) - 1))
+
+def test_no_eager_imports():
+    # pywt and scipy.signal come through the lazy modules of the backend
+    import inspect
+    source = inspect.getsource(chunked)
+    assert 'import pywt' not in source and 'import scipy' not in source
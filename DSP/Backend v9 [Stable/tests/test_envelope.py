@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import scipy.signal as signal
+
+import CoE199_main_v9 as backend
+from conftest import quiet, recording
+
+# The envelope stage pads the FFT to a fast length. At a fast length it has to give the envelope of signal.hilbert, at
+# other lengths it has to stay close to it away from the ends and keep the rates of analyze
+
+samplerate = 2000
+
+def relative_error(data):
+    reference = np.abs(signal.hilbert(data))
+    return np.abs(backend.envelope_stage.envelope(data) - reference) / np.max(reference)
+
+class HilbertStage(backend.EnvelopeStage):
+    def envelope(self, data, axis = -1):
+        return np.abs(signal.hilbert(data, axis=axis))
+
+@pytest.mark.parametrize('n', [40000, 2**15, 120000])
+def test_fast_length_matches_hilbert(n):
+    data = np.random.default_rng(n).standard_normal(n)
+    assert relative_error(data).max() < 1e-10
+
+@pytest.mark.parametrize('n', [39989, 39997, 40009])
+def test_awkward_length_white_noise(n):
+    error = relative_error(np.random.default_rng(n).standard_normal(n))
+    assert error[n//10:-(n//10)].max() < 1e-2
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('n', [39989, 40009])
+def test_awkward_length_pipeline_waves(seed, n):
+    results = quiet(backend.analyze, recording(21, seed=seed)[:n], samplerate)
+    for wave in (results['level5_wave'], results['level7_wave']):
+        error = relative_error(wave)
+        # Close away from the ends, only the first and last few hundred samples feel the padding
+        assert error[n//10:-(n//10)].max() < 1e-4
+        assert error.max() < 0.5
+
+@pytest.mark.parametrize('heart_rate', [55, 72, 140])
+def test_awkward_length_rates(monkeypatch, heart_rate):
+    data = recording(31, seed=heart_rate, heart_rate=heart_rate, noise_level=0.3)[:59999]
+    results = quiet(backend.analyze, data, samplerate)
+    monkeypatch.setattr(backend, 'envelope_stage', HilbertStage())
+    reference = quiet(backend.analyze, data, samplerate)
+    assert abs(results['heartrate'] - reference['heartrate']) < 0.01
+    assert abs(results['respiratoryrate'] - reference['respiratoryrate']) < 0.01
@@ -0,0 +1,62 @@
+import numpy as np
+
+import CoE199_main_v9 as backend
+import CoE199_motion_v9 as motion
+from conftest import quiet, recording
+
+# The motion gate takes the heart rate from every clean span of at least hr_minimum seconds and the respiratory rate only
+# from the spans of at least rr_minimum seconds
+
+samplerate = 2000
+still = 981                                                     # 9.81 m/s^2 as imu_buf stores it
+
+def accelerometer(duration, moving = ()):
+    # moving is a list of (start, end) seconds where the magnitude is over the threshold
+    imu = np.full(int(duration*motion.nus.imu_samplerate), still, dtype=np.int16)
+    for start, end in moving:
+        imu[int(start*motion.nus.imu_samplerate):int(end*motion.nus.imu_samplerate)] = 2500
+    return imu
+
+def test_without_motion():
+    data, imu = recording(20), accelerometer(20)
+    results = quiet(motion.analyze_with_motion, data, samplerate, imu)
+    reference = quiet(backend.analyze, data, samplerate)
+    np.testing.assert_equal(results['heartrate'], reference['heartrate'])
+    np.testing.assert_equal(results['respiratoryrate'], reference['respiratoryrate'])
+    assert (results['hr_spans'], results['rr_spans'], results['errors']) == (1, 1, [])
+
+def test_short_still_recording():
+    # Without motion the whole recording is one clean span and goes through the same minimums
+    data, imu = recording(10), accelerometer(10)
+    results = quiet(motion.analyze_with_motion, data, samplerate, imu)
+    assert (results['hr_spans'], results['rr_spans']) == (1, 0)
+    assert np.isfinite(results['heartrate']) and np.isnan(results['respiratoryrate'])
+    assert len(results['rr_peaks']) == 0
+    data, imu = recording(3), accelerometer(3)
+    results = quiet(motion.analyze_with_motion, data, samplerate, imu)
+    assert (results['hr_spans'], results['rr_spans']) == (0, 0)
+    assert np.isnan(results['heartrate']) and np.isnan(results['respiratoryrate'])
+
+def test_nan_rate_is_not_a_span():
+    # Silence gives no heart or breath peaks, so no rate and no span
+    results = quiet(motion.analyze_with_motion, np.zeros(20*samplerate), samplerate, accelerometer(20))
+    assert (results['hr_spans'], results['rr_spans']) == (0, 0)
+
+def test_short_span_only_gives_heart_rate():
+    # Clean spans of 19.75s, 28.5s and 8.75s, the last one is too short for the respiratory rate
+    data, imu = recording(60), accelerometer(60, [(20, 21), (50, 51)])
+    results = quiet(motion.analyze_with_motion, data, samplerate, imu)
+    np.testing.assert_equal(results['segments'], [[0, 39500], [42500, 99500], [102500, 120000]])
+    assert (results['hr_spans'], results['rr_spans'], results['errors']) == (3, 2, [])
+    assert np.any(results['hr_peaks'].indices >= 102500)
+    assert not np.any(results['rr_peaks'].indices >= 102500)
+    assert abs(results['heartrate'] - 72) < 2
+    assert abs(results['respiratoryrate'] - 16) < 2
+
+def test_no_span_long_enough_for_respiratory_rate():
+    data, imu = recording(12), accelerometer(12, [(5, 6)])
+    results = quiet(motion.analyze_with_motion, data, samplerate, imu)
+    assert (results['hr_spans'], results['rr_spans']) == (1, 0)
+    assert np.isfinite(results['heartrate'])
+    assert np.isnan(results['respiratoryrate'])
+    assert len(results['rr_peaks']) == 0
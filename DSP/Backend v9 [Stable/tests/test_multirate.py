@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+import scipy.signal as signal
+
+import CoE199_main_v9 as backend
+import CoE199_synthetic_v9 as synthetic
+from conftest import quiet
+
+# analyze_multirate against analyze on the same recordings. At 2kHz the wavelet bands and the whole RR branch are the same,
+# only the HR peaks are found at 500Hz, so the heart rate is compared within a tolerance.
+
+hr_tolerance = 0.5                                              # BPM
+
+def both(data, samplerate):
+    return quiet(backend.analyze, data, samplerate), quiet(backend.analyze_multirate, data, samplerate)
+
+def test_working_rates():
+    assert backend.working_samplerate(2000, 200, 5) == (500, 3)
+    assert backend.working_samplerate(2000, 950, 3) == (2000, 3)
+    assert backend.working_samplerate(8000, 200, 5) == (500, 3)
+    # The 950Hz edge of the RR band needs 4kHz with the margin, a 2kHz recording is never upsampled for it
+    assert backend.working_samplerate(8000, 950, 3) == (4000, 4)
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_same_bands_at_2khz(seed):
+    data, samplerate = synthetic.generate(20, seed=seed, scale=None)
+    reference, result = both(data, samplerate)
+    assert result['hr_samplerate'] == 500 and result['rr_samplerate'] == 2000
+    np.testing.assert_array_equal(result['hr_denoised_coefficients'][5], reference['hr_denoised_coefficients'][5])
+    np.testing.assert_array_equal(result['rr_denoised_coefficients'][3], reference['rr_denoised_coefficients'][3])
+    np.testing.assert_allclose(result['level7_wave'], reference['level7_wave'], rtol=0, atol=1e-12)
+    assert result['rr_peaks'] == reference['rr_peaks']
+    assert result['respiratoryrate'] == reference['respiratoryrate']
+
+@pytest.mark.parametrize('heart_rate', [70, 80, 100, 120, 140, 150])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_heart_rate_at_2khz(heart_rate, seed):
+    data, samplerate = synthetic.generate(20, heart_rate=heart_rate, noise_level=0.05, seed=seed, scale=None)
+    reference, result = both(data, samplerate)
+    assert abs(result['heartrate'] - reference['heartrate']) <= hr_tolerance
+
+    # The peaks mapped back to the recording are the peaks of analyze, a few samples of the 4 times coarser grid away
+    peaks = result['hr_peaks'].indices
+    reference_peaks = reference['hr_peaks'].indices
+    distance = np.min(np.abs(peaks[:, None] - reference_peaks[None, :]), axis=1)
+    assert np.mean(distance <= 8) >= 0.95
+
+def test_level5_wave_at_500hz():
+    # The band reconstructed at 500Hz follows every 4th sample of the band of analyze
+    data, samplerate = synthetic.generate(20, seed=2, scale=None)
+    reference, result = both(data, samplerate)
+    wave = result['level5_wave']
+    i = np.arange(250, wave.size - 250)
+    error = np.max(np.abs(wave[i] - reference['level5_wave'][4*i + 2])) / np.max(np.abs(reference['level5_wave']))
+    assert error < 0.05
+
+@pytest.mark.parametrize('samplerate', [4000, 8000])
+@pytest.mark.parametrize('heart_rate', [80, 100, 120])
+def test_higher_rates(samplerate, heart_rate):
+    # A 4kHz or 8kHz recording uses the same bands in Hz as the same recording taken down to 2kHz
+    data, _ = synthetic.generate(20, samplerate=samplerate, heart_rate=heart_rate, seed=heart_rate, scale=None)
+    reference = quiet(backend.analyze, signal.resample_poly(data, 2000, samplerate), 2000)
+    result = quiet(backend.analyze_multirate, data, samplerate)
+    assert result['hr_samplerate'] == 500 and result['rr_samplerate'] == 4000
+    assert abs(result['heartrate'] - reference['heartrate']) <= hr_tolerance
+    assert abs(result['respiratoryrate'] - reference['respiratoryrate']) <= 0.5
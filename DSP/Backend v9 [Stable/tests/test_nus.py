@@ -0,0 +1,113 @@
+import numpy as np
+
+import CoE199_nus_v9 as nus
+
+# The decoder has to split a transfer at the footers the firmware sends, without copying the samples and without being
+# fooled by footer bytes at an odd offset, and hold_failed has to replace the -1 of a failed read with the sample before it
+
+def transfer(audio, imu = None):
+    payload = np.asarray(audio, dtype='<i2').tobytes() + nus.audio_footer
+    if imu is not None:
+        payload += np.asarray(imu, dtype='<i2').tobytes() + nus.imu_footer
+    return payload
+
+def audio_samples(n = 1000, seed = 0):
+    rng = np.random.default_rng(seed)
+    audio = (2048 + rng.integers(-300, 300, n)).astype('<i2')
+    audio[[10, 11, 500]] = nus.failed_read
+    return audio
+
+# This part is for the footers
+def test_decode_audio_and_imu():
+    audio = audio_samples()
+    imu = np.full(50, 981, dtype='<i2')
+    recording = nus.decode(transfer(audio, imu))
+    np.testing.assert_array_equal(recording.audio, audio)
+    np.testing.assert_array_equal(recording.imu, imu)
+    np.testing.assert_array_equal(np.flatnonzero(recording.failed), [10, 11, 500])
+    np.testing.assert_allclose(recording.motion(), 9.81)
+    # Views of the received bytes, not copies
+    assert not recording.audio.flags.writeable and not recording.audio.flags.owndata
+
+def test_decode_packets():
+    payload = transfer(audio_samples(), np.full(50, 981))
+    packets = [payload[k:k + 200] for k in range(0, len(payload), 200)]
+    recording = nus.decode(packets)
+    np.testing.assert_array_equal(recording.audio, nus.decode(payload).audio)
+    np.testing.assert_array_equal(recording.imu, nus.decode(payload).imu)
+
+def test_continuous_mode_without_imu():
+    audio = audio_samples()
+    recording = nus.decode(transfer(audio))
+    np.testing.assert_array_equal(recording.audio, audio)
+    assert recording.imu.size == 0
+
+def test_footer_at_odd_offset():
+    # "finished\n" starting on the high byte of a sample is not a footer
+    decoy = b'\x00' + nus.audio_footer                        # 10 bytes, the footer at offset 1
+    assert nus.find_footer(decoy + nus.audio_footer, nus.audio_footer) == len(decoy)
+    recording = nus.decode(decoy + nus.audio_footer + b'\x01\x00' + nus.imu_footer)
+    assert recording.audio.size == len(decoy) // 2
+    np.testing.assert_array_equal(recording.imu, [1])
+    # The IMU footer is looked for at even offsets from the start of the IMU
+    imu = b'\x01\x00' + b'\x00' + nus.imu_footer + b'\x00' + b'\x02\x00'
+    recording = nus.decode(nus.audio_footer + imu + nus.imu_footer)
+    assert recording.audio.size == 0
+    assert recording.imu.size == (len(imu)) // 2
+    assert recording.imu[-1] == 2
+
+# This part is for transfers that were cut off
+def test_no_footer_is_all_audio():
+    audio = audio_samples()
+    recording = nus.decode(audio.tobytes())
+    np.testing.assert_array_equal(recording.audio, audio)
+    assert recording.imu.size == 0
+
+def test_odd_length_drops_the_stray_byte():
+    audio = audio_samples()
+    recording = nus.decode(audio.tobytes()[:-1])
+    np.testing.assert_array_equal(recording.audio, audio[:-1])
+    # A stray byte in the IMU puts its footer at an odd offset, so the whole IMU is left out and the audio is kept
+    recording = nus.decode(transfer(audio) + b'\xd5\x03\xd5' + nus.imu_footer)
+    np.testing.assert_array_equal(recording.audio, audio)
+    assert recording.imu.size == 0
+
+def test_truncated_imu():
+    # The audio is complete, the IMU stopped before its footer and is left out
+    audio = audio_samples()
+    payload = transfer(audio, np.full(50, 981))
+    recording = nus.decode(payload[:len(audio)*2 + len(nus.audio_footer) + 31])
+    np.testing.assert_array_equal(recording.audio, audio)
+    assert recording.imu.size == 0
+
+def test_truncated_audio_footer():
+    # Half a footer is not a footer, the samples before it are all kept
+    audio = audio_samples()
+    recording = nus.decode(audio.tobytes() + nus.audio_footer[:4])
+    np.testing.assert_array_equal(recording.audio[:audio.size], audio)
+    assert recording.audio.size == audio.size + 2
+
+# This part is for the failed reads
+def test_hold_failed():
+    samples = np.array([5, -1, -1, 7, -1, 9], dtype='<i2')
+    np.testing.assert_array_equal(nus.hold_failed(samples), [5, 5, 5, 7, 7, 9])
+
+def test_hold_failed_at_the_start():
+    samples = np.array([-1, -1, 4, -1], dtype='<i2')
+    # Without the chunk before, the first good sample stands in for the failed reads before it
+    np.testing.assert_array_equal(nus.hold_failed(samples), [4, 4, 4, 4])
+    np.testing.assert_array_equal(nus.hold_failed(samples, previous=2), [2, 2, 4, 4])
+    np.testing.assert_array_equal(nus.hold_failed(np.full(3, -1, dtype='<i2')), [0, 0, 0])
+    np.testing.assert_array_equal(nus.hold_failed(np.full(3, -1, dtype='<i2'), previous=6), [6, 6, 6])
+
+def test_hold_failed_mask():
+    recording = nus.decode(transfer(audio_samples()))
+    held = nus.hold_failed(recording.audio, recording.failed)
+    assert held.dtype == np.float64
+    np.testing.assert_array_equal(held[[10, 11]], recording.audio[9])
+    np.testing.assert_array_equal(held[500], recording.audio[499])
+    keep = ~recording.failed
+    np.testing.assert_array_equal(held[keep], recording.audio[keep])
+    # Nothing failed, nothing changes
+    samples = np.array([1, 2, 3], dtype='<i2')
+    np.testing.assert_array_equal(nus.hold_failed(samples), samples)
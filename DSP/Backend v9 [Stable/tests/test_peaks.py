@@ -0,0 +1,191 @@
+import numpy as np
+import pytest
+
+import CoE199_main_v9 as backend
+import CoE199_synthetic_v9 as synthetic
+from conftest import quiet
+
+# The fast detectors have to find exactly the peaks of the original per-sample loops, on the envelopes the pipeline gives
+# them and on hand made ones with the edge cases
+
+samplerate = 2000
+
+def envelopes(duration, heart_rate, noise_level, seed = 0):
+    data, samplerate = synthetic.generate(duration, heart_rate=heart_rate, respiratory_rate=16, noise_level=noise_level,
+                                          seed=seed, scale=None)
+    results = quiet(backend.analyze, data, samplerate)
+    return results['hr_envelope'], results['rr_envelope']
+
+def pulses(duration, period, jitter = 0.0, seed = 0, width = 0.05, base = 0.1):
+    # A pulse of width seconds every period seconds on a constant base
+    rng = np.random.default_rng(seed)
+    envelope = np.full(int(duration*samplerate), base)
+    pulse = np.hanning(int(width*samplerate))
+    start = 0.25
+    while start < duration:
+        i = int(round(start*samplerate))
+        envelope[i:i+pulse.size] += pulse[:envelope.size-i]
+        start += period * (1 + jitter*rng.standard_normal())
+    return envelope
+
+def assert_same_hr(envelope):
+    time = backend.TimeAxis(samplerate, envelope.size)
+    reference_rate, reference_peaks = quiet(backend.hr_peak_detection, envelope, time, samplerate)
+    rate, peaks = quiet(backend.hr_peak_detection_fast, envelope, time, samplerate, compiled=False)
+    assert peaks == reference_peaks
+    np.testing.assert_equal(rate, reference_rate)
+    return peaks
+
+def assert_same_rr(envelope, default = 1):
+    time = backend.TimeAxis(samplerate, envelope.size)
+    reference_rate, reference_peaks, reference_areas = quiet(backend.rr_peak_detection, envelope, time, samplerate, default)
+    rate, peaks, areas = quiet(backend.rr_peak_detection_fast, envelope, time, samplerate, default)
+    assert peaks == reference_peaks
+    np.testing.assert_equal(rate, reference_rate)
+    np.testing.assert_allclose(areas, reference_areas, rtol=1e-9, atol=1e-12)
+    return peaks
+
+# This part is for the heart rate detector
+@pytest.mark.parametrize('heart_rate', [50, 72, 110, 150])
+@pytest.mark.parametrize('noise_level', [0.05, 0.3, 1.0])
+def test_hr_matches_reference(heart_rate, noise_level):
+    hr_envelope, _ = envelopes(20, heart_rate, noise_level, seed=heart_rate)
+    assert len(assert_same_hr(hr_envelope)) > 0
+
+@pytest.mark.parametrize('duration', [1, 5, 60])
+def test_hr_matches_reference_lengths(duration):
+    hr_envelope, _ = envelopes(duration, 72, 0.3)
+    assert_same_hr(hr_envelope)
+
+def test_hr_shorter_than_window():
+    # No sample is past the first moving average window, so there is no candidate
+    peaks = assert_same_hr(pulses(0.4, 0.2))
+    assert len(peaks) == 0
+
+def test_hr_flat_segment():
+    envelope = pulses(20, 0.8, jitter=0.05)
+    envelope[6*samplerate:12*samplerate] = 0
+    peaks = assert_same_hr(envelope)
+    assert not np.any((peaks.indices >= 6*samplerate) & (peaks.indices < 12*samplerate))
+
+def test_hr_zero_stdev():
+    # Equally spaced pulses give the same distance every time, so the standard deviation of the distances is 0.
+    # hr_peak_detection divides by it, the fast detector accepts every pulse whose distance is the mean.
+    envelope = pulses(20, 0.8)
+    time = backend.TimeAxis(samplerate, envelope.size)
+    with pytest.raises(ZeroDivisionError):
+        quiet(backend.hr_peak_detection, envelope, time, samplerate)
+    _, peaks = quiet(backend.hr_peak_detection_fast, envelope, time, samplerate, compiled=False)
+    assert len(peaks) == 24
+    assert np.all(np.diff(peaks.indices) == int(0.8*samplerate))
+
+# This part is for the compiled loop of the heart rate detector
+compiled_modes = [False, pytest.param(True, marks=pytest.mark.skipif(not backend.numba_available, reason='needs numba'))]
+
+@pytest.mark.parametrize('compiled', compiled_modes)
+@pytest.mark.parametrize('heart_rate', [50, 110, 150])
+@pytest.mark.parametrize('noise_level', [0.05, 1.0])
+def test_hr_tracker_compiled(compiled, heart_rate, noise_level):
+    hr_envelope, _ = envelopes(20, heart_rate, noise_level, seed=heart_rate)
+    candidates = backend.hr_threshold_candidates(hr_envelope, samplerate)
+    reference = backend.HrPeakTracker(samplerate, compiled=False)
+    reference.update(candidates)
+    # Blocks of uneven sizes check that the state carries over between updates
+    tracker = backend.HrPeakTracker(samplerate, compiled=compiled)
+    for part in np.array_split(candidates, [1, 7, candidates.size//2]):
+        tracker.update(part)
+    assert tracker.peaks == reference.peaks
+    assert tracker.next_allowed == reference.next_allowed
+    assert tracker.cumulative_peak_difference == reference.cumulative_peak_difference
+    assert tracker.cumulative_square_distance == reference.cumulative_square_distance
+
+@pytest.mark.parametrize('compiled', compiled_modes)
+def test_hr_tracker_compiled_zero_stdev(compiled):
+    envelope = pulses(20, 0.8)
+    time = backend.TimeAxis(samplerate, envelope.size)
+    _, peaks = quiet(backend.hr_peak_detection_fast, envelope, time, samplerate, compiled=compiled)
+    assert len(peaks) == 24
+
+def test_hr_tracker_auto():
+    assert backend.HrPeakTracker(samplerate).compiled == backend.numba_available
+    assert backend.HrPeakTracker(samplerate, compiled=False).compiled is False
+
+def test_hr_tracker_fallback(monkeypatch):
+    monkeypatch.setattr(backend, 'numba_available', False)
+    assert backend.HrPeakTracker(samplerate).compiled is False
+    with pytest.warns(RuntimeWarning, match='numba'):
+        tracker = backend.HrPeakTracker(samplerate, compiled=True)
+    assert tracker.compiled is False
+    envelope = pulses(20, 0.8, jitter=0.05)
+    tracker.update(backend.hr_threshold_candidates(envelope, samplerate))
+    assert tracker.peaks == assert_same_hr(envelope).indices.tolist()
+
+@pytest.mark.skipif(not backend.numba_available, reason='needs numba')
+@pytest.mark.parametrize('heart_rate', [50, 110, 150])
+def test_check_compiled(heart_rate):
+    hr_envelope, _ = envelopes(60, heart_rate, 0.3, seed=heart_rate)
+    assert backend.check_compiled(hr_envelope, samplerate)
+
+@pytest.mark.skipif(not backend.numba_available, reason='needs numba')
+@pytest.mark.parametrize('pipeline', ['analyze', 'analyze_multirate', 'analyze_batch', 'analyze_chunked'])
+def test_pipeline_compiled(pipeline):
+    # compiled reaches the tracker of every entry point and does not change the results
+    import CoE199_chunked_v9 as chunked
+    data, _ = synthetic.generate(30, heart_rate=90, respiratory_rate=16, noise_level=0.3, seed=3, scale=None)
+    function = chunked.analyze_chunked if pipeline == 'analyze_chunked' else getattr(backend, pipeline)
+    python = quiet(function, data, samplerate, compiled=False)
+    compiled = quiet(function, data, samplerate, compiled=True)
+    np.testing.assert_equal(compiled['heartrate'], python['heartrate'])
+    if 'hr_peaks' in python:
+        assert compiled['hr_peaks'] == python['hr_peaks']
+
+# This part is for the respiratory rate detector
+@pytest.mark.parametrize('respiratory_rate', [8, 16, 30])
+@pytest.mark.parametrize('noise_level', [0.05, 1.0])
+@pytest.mark.parametrize('default', [0, 1])
+def test_rr_matches_reference(respiratory_rate, noise_level, default):
+    data, _ = synthetic.generate(20, respiratory_rate=respiratory_rate, noise_level=noise_level, seed=respiratory_rate,
+                                 scale=None)
+    rr_envelope = quiet(backend.analyze, data, samplerate)['rr_envelope']
+    assert len(assert_same_rr(rr_envelope, default)) > 0
+
+@pytest.mark.parametrize('duration', [5, 60])
+def test_rr_matches_reference_lengths(duration):
+    _, rr_envelope = envelopes(duration, 72, 0.3)
+    assert_same_rr(rr_envelope)
+
+@pytest.mark.parametrize('n', [2, 999, 1000, 1001])
+def test_rr_shorter_than_transient(n):
+    # Every peak is inside the first transient (0.5s, 1000 samples), so none is kept and the rate is NaN
+    envelope = pulses(n / samplerate + 0.01, 0.1, width=0.02, base=0.0)[:n]
+    peaks = assert_same_rr(envelope)
+    assert len(peaks) == 0
+
+def breaths(n, starts, tau = 0.05):
+    # Breath bumps that rise and decay at different speeds, so that the area of a window has a single highest sample
+    # instead of a flat top where rounding picks the peak. A start before 0 cuts the bump.
+    envelope = np.zeros(n)
+    for start in starts:
+        t = np.maximum(np.arange(n) - start, 0) / samplerate
+        envelope += t / tau * np.exp(1 - t / tau)
+    return envelope
+
+@pytest.mark.parametrize('shift', [-10, 0, 1, 2, 3, 10])
+def test_rr_transient_boundary(shift):
+    # The first area peak lands around the end of the transient (0.5s, 1000 samples), at 999 for the bumps that start at
+    # 0 or before and at 1000 + shift after that. The others are 2s apart.
+    envelope = breaths(6*samplerate, [shift, shift + 2*samplerate, shift + 4*samplerate])
+    first = np.argmax(backend.normalized_area(envelope, samplerate)[:samplerate + samplerate//2])
+    peaks = assert_same_rr(envelope)
+    assert len(peaks) >= 2
+    assert (first in peaks.indices) == (first > samplerate*0.5)
+
+@pytest.mark.parametrize('n', [999, 1000, 1001, 1500])
+def test_rr_window_boundary(n):
+    # The sliding area switches from growing windows to full windows of samplerate//2 samples at sample 1000
+    rng = np.random.default_rng(n)
+    envelope = np.abs(rng.standard_normal(n)) + np.sin(np.arange(n) / n * 4 * np.pi)**2
+    assert_same_rr(envelope)
+    areas = backend.sliding_area(envelope, samplerate//2)
+    reference = [np.trapz(envelope[0 : i+1]) if i < samplerate//2 else np.trapz(envelope[i-samplerate//2 : i]) for i in range(n)]
+    np.testing.assert_allclose(areas, reference, rtol=1e-9, atol=1e-9)
@@ -0,0 +1,79 @@
+import numpy as np
+
+import CoE199_main_v9 as backend
+import CoE199_quality_v9 as quality
+import CoE199_synthetic_v9 as synthetic
+from conftest import quiet
+
+# The quality check has to reject the recordings the pipeline cannot use without rejecting quiet ones, and it has to read
+# -1 as a failed read only in the raw int16 samples of the ADC
+
+samplerate = 2000
+mid_scale = 2048                                                # the 12 bit ADC sits at mid-scale without sound
+
+def normalized(seed = 0):
+    data, _ = synthetic.generate(20, samplerate, heart_rate=72, respiratory_rate=16, noise_level=0.3, seed=seed, scale=None)
+    return data / np.max(np.abs(data))
+
+def adc(amplitude, seed = 0):
+    return (mid_scale + np.round(amplitude*normalized(seed))).astype(np.int16)
+
+# This part is for the flat check
+def test_low_amplitude_passes():
+    # At 6 LSB about a third of the samples repeat the one before, but no value is held for long
+    data = adc(6)
+    assert np.mean(data[1:] == data[:-1]) > 0.3
+    result = quality.signal_quality(data, samplerate)
+    assert result.passed
+    assert result.flat == 0
+
+def test_stuck_adc_fails():
+    data = adc(2000)
+    data[4000:30000] = data[4000]
+    result = quality.signal_quality(data, samplerate)
+    assert result.reasons == ['flat']
+    assert result.flat > 0.5
+
+def test_silent_fails():
+    result = quality.signal_quality(np.full(40000, mid_scale, dtype=np.int16), samplerate)
+    assert result.reasons == ['flat']
+    assert result.score == -1
+
+def test_flat_fraction_runs():
+    # Runs shorter than flat_run do not count, longer ones count with every sample
+    data = np.arange(1000, dtype=np.int16)
+    data[100:199] = 7
+    assert quality.flat_fraction(data, samplerate) == 0
+    data[300:500] = 9
+    assert quality.flat_fraction(data, samplerate) == 0.2
+
+# This part is for the failed reads
+def test_failed_reads_int16():
+    data = adc(2000)
+    data[::10] = -1
+    result = quality.signal_quality(data, samplerate)
+    assert result.reasons == ['failed']
+    assert abs(result.failed - 0.1) < 1e-3
+
+def test_float_minus_one_is_a_sample():
+    # A float wav normalized to full scale has -1.0 at its loudest negative sample
+    data = normalized()
+    data = data if data.min() == -1 else -data
+    assert np.count_nonzero(data == -1) == 1
+    result = quality.signal_quality(data, samplerate)
+    assert result.passed
+    assert result.failed is None
+    results = quiet(quality.analyze_checked, data, samplerate)
+    reference = quiet(backend.analyze, data, samplerate)
+    np.testing.assert_equal(results['level5_wave'], reference['level5_wave'])
+    np.testing.assert_equal(results['heartrate'], reference['heartrate'])
+
+def test_failed_reads_held_int16():
+    data = adc(2000)
+    data[1000:1010] = -1
+    results = quiet(quality.analyze_checked, data, samplerate)
+    held = data.astype(np.float64)
+    held[1000:1010] = held[999]
+    reference = quiet(backend.analyze, held, samplerate)
+    np.testing.assert_equal(results['heartrate'], reference['heartrate'])
+    np.testing.assert_equal(results['level5_wave'], reference['level5_wave'])
@@ -0,0 +1,149 @@
+import asyncio
+import concurrent.futures
+import pytest
+
+from CoE199_scheduler_v9 import Scheduler, Shed, rates, debug
+
+# The scheduler is driven by an executor that only runs a job when the test says so, which makes the order of the jobs,
+# the queue depth and the shedding deterministic
+
+class ManualExecutor:
+    def __init__(self):
+        self.pending = []
+        self.order = []
+
+    def submit(self, function, *args):
+        future = concurrent.futures.Future()
+        self.pending.append((function, args, future))
+        return future
+
+    async def run_next(self):
+        function, args, future = self.pending.pop(0)
+        future.set_result(function(*args))
+        await settle()
+
+    async def run_all(self):
+        while self.pending:
+            await self.run_next()
+
+async def settle():
+    # The result goes from the executor future to the asyncio future and from there to the next job of the scheduler
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+def job(executor, name):
+    def function():
+        executor.order.append(name)
+        return name
+    return function
+
+def submit(scheduler, executor, device, name, priority = rates):
+    return asyncio.ensure_future(scheduler.submit(device, job(executor, name), priority=priority))
+
+def test_devices_take_turns():
+    async def run():
+        executor = ManualExecutor()
+        scheduler = Scheduler(executor, workers=1, capacity=64, per_device=None)
+        tasks = [submit(scheduler, executor, 'X', 'X0')]
+        for device in 'ABC':
+            tasks += [submit(scheduler, executor, device, f'{device}{k}') for k in range(3)]
+        await settle()
+        # X0 runs, everything else waits in the queue
+        assert len(executor.pending) == 1 and scheduler.depth == 9
+        await executor.run_all()
+        await asyncio.gather(*tasks)
+        return executor.order
+    assert asyncio.run(run()) == ['X0', 'A0', 'B0', 'C0', 'A1', 'B1', 'C1', 'A2', 'B2', 'C2']
+
+def test_rates_before_debug():
+    async def run():
+        executor = ManualExecutor()
+        scheduler = Scheduler(executor, workers=1, capacity=64, per_device=None)
+        tasks = [submit(scheduler, executor, 'X', 'X0')]
+        tasks += [submit(scheduler, executor, 'A', 'debug A', debug), submit(scheduler, executor, 'B', 'rates B')]
+        await settle()
+        await executor.run_all()
+        await asyncio.gather(*tasks)
+        return executor.order
+    assert asyncio.run(run()) == ['X0', 'rates B', 'debug A']
+
+def test_burst_sheds_debug_first():
+    async def run():
+        executor = ManualExecutor()
+        scheduler = Scheduler(executor, workers=1, capacity=4, per_device=None)
+        running = submit(scheduler, executor, 'X', 'X0')
+        debug_jobs = [submit(scheduler, executor, device, f'debug {device}', debug) for device in 'AABC']
+        await settle()
+        assert scheduler.depth == 4
+
+        # A full queue sheds a new debug job right away
+        with pytest.raises(Shed):
+            await scheduler.submit('D', job(executor, 'debug D'), priority=debug)
+        # and a new rates job takes the place of the oldest debug job of the device with the most of them
+        rates_jobs = [submit(scheduler, executor, device, f'rates {device}') for device in 'EF']
+        await settle()
+        assert scheduler.depth == 4 and scheduler.max_depth == 4
+        assert isinstance(debug_jobs[0].exception(), Shed) and isinstance(debug_jobs[1].exception(), Shed)
+
+        await executor.run_all()
+        await asyncio.gather(running, *rates_jobs, *debug_jobs[2:])
+        return executor.order, scheduler.stats()
+    order, stats = asyncio.run(run())
+    assert order == ['X0', 'rates E', 'rates F', 'debug B', 'debug C']
+    assert stats['debug_shed'] == 3 and stats['rates_shed'] == 0
+    assert stats['max_depth'] == 4 and stats['depth'] == 0 and stats['running'] == 0
+
+def test_full_queue_holds_back_rates():
+    async def run():
+        executor = ManualExecutor()
+        scheduler = Scheduler(executor, workers=1, capacity=2, per_device=None)
+        tasks = [submit(scheduler, executor, device, device) for device in 'XAB']
+        waiting = submit(scheduler, executor, 'C', 'C')
+        await settle()
+        # Without a debug job to shed, C waits for space instead of growing the queue
+        assert scheduler.depth == 2 and not waiting.done()
+        assert scheduler.stats()['devices_waiting'] == 2
+        depths = []
+        while executor.pending:
+            await executor.run_next()
+            depths.append(scheduler.depth)
+        await asyncio.gather(*tasks, waiting)
+        return executor.order, depths, scheduler
+    order, depths, scheduler = asyncio.run(run())
+    assert order == ['X', 'A', 'B', 'C']
+    assert max(depths) <= 2 and scheduler.max_depth == 2
+
+def test_per_device_limit():
+    async def run():
+        executor = ManualExecutor()
+        scheduler = Scheduler(executor, workers=1, capacity=64, per_device=2)
+        running = submit(scheduler, executor, 'X', 'X0')
+        tasks = [submit(scheduler, executor, 'A', f'A{k}') for k in range(3)]
+        other = submit(scheduler, executor, 'B', 'B0')
+        await settle()
+        # A has two queued jobs, its third waits while B still gets in
+        assert scheduler.queued('A') == 2 and scheduler.queued('B') == 1
+        assert not tasks[2].done()
+        await executor.run_all()
+        await asyncio.gather(running, other, *tasks)
+        return executor.order
+    assert asyncio.run(run()) == ['X0', 'A0', 'B0', 'A1', 'A2']
+
+def test_stats_wait_times():
+    async def run():
+        executor = ManualExecutor()
+        scheduler = Scheduler(executor, workers=2, capacity=8, per_device=None)
+        tasks = [submit(scheduler, executor, f'device-{d}', d) for d in range(5)]
+        await settle()
+        stats = scheduler.stats()
+        assert (stats['running'], stats['depth'], stats['rates_started']) == (2, 3, 2)
+        await asyncio.sleep(0.02)
+        await executor.run_all()
+        await asyncio.gather(*tasks)
+        return scheduler.stats()
+    stats = asyncio.run(run())
+    assert (stats['running'], stats['depth'], stats['max_depth'], stats['rates_started']) == (0, 0, 3, 5)
+    # The three queued jobs waited at least the 20ms before the first job finished
+    assert stats['rates_wait_max_ms'] >= 20 and stats['rates_wait_p95_ms'] >= 20
+    assert 0 <= stats['rates_wait_mean_ms'] <= stats['rates_wait_max_ms']
+    assert 'debug_wait_mean_ms' not in stats and stats['debug_started'] == 0
@@ -0,0 +1,60 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import pytest
+
+import CoE199_server_v9 as server_module
+
+# A simulated session has to go through the commands the firmware knows, and end with the exact "stop" it compares with
+# strcmp
+
+def run_session(recordings, executor = ThreadPoolExecutor, transport = 'socketpair'):
+    async def session():
+        server = server_module.IngestionServer(executor(max_workers=1), record_seconds=0, recordings=recordings)
+        device = server_module.synthetic_device(72, 16, speed=None)
+        try:
+            results = await asyncio.wait_for(server_module.simulate(server, [device], transport), 60)
+        finally:
+            await server.close()
+        return device, results
+    return asyncio.run(session())
+
+# A forked pool worker keeps a copy of the socket of the session that started it, so only the end of the write side
+# of the link tells the device that "stop" is complete
+@pytest.mark.parametrize('executor, transport', [(ThreadPoolExecutor, 'socketpair'), (ProcessPoolExecutor, 'tcp')])
+def test_session_stops_device(executor, transport):
+    device, results = run_session(2, executor, transport)
+    assert device.stopped
+    assert device.unknown == []
+    assert len(results) == 2
+    assert all(result.error is None and np.isfinite(result.heart_rate) for result in results)
+
+def test_stop_with_newline_is_unknown():
+    async def command(payload):
+        device = server_module.DeviceSimulator(np.zeros(10), speed=None)
+        reader = asyncio.StreamReader()
+        reader.feed_data(payload)
+        reader.feed_eof()
+        writer = Writer()
+        await device.run(reader, writer)
+        return device, writer.data
+    device, answer = asyncio.run(command(b"stop\n"))
+    assert not device.stopped
+    assert device.unknown == [b"stop\n"]
+    assert answer == b"Unknown Command!\n"
+    device, answer = asyncio.run(command(b"stop"))
+    assert device.stopped and answer == b""
+
+class Writer:
+    # Collects what the device writes back
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,36 @@
+import numpy as np
+
+import CoE199_stream_v9 as stream
+from conftest import recording
+
+# The streaming analyzer has to hold the failed reads of the raw int16 samples, also across chunks and packets, and has to
+# keep -1.0 in float samples where it is a sample like any other
+
+def test_int16_failed_reads_are_held():
+    analyzer = stream.StreamingAnalyzer()
+    np.testing.assert_array_equal(analyzer.samples(np.array([5, -1, 7], dtype=np.int16)), [5, 5, 7])
+    # The last sample of the chunk before stands in for failed reads at the start of the next one
+    np.testing.assert_array_equal(analyzer.samples(np.array([-1, -1, 8], dtype=np.int16)), [7, 7, 8])
+
+def test_bytes_failed_reads_are_held():
+    analyzer = stream.StreamingAnalyzer()
+    payload = np.array([5, -1, 7, -1], dtype='<i2').tobytes()
+    # A packet that ends on half a sample leaves the byte for the next one
+    np.testing.assert_array_equal(analyzer.samples(payload[:5]), [5, 5])
+    np.testing.assert_array_equal(analyzer.samples(payload[5:]), [7, 7])
+
+def test_float_minus_one_is_a_sample():
+    analyzer = stream.StreamingAnalyzer()
+    chunk = np.array([0.5, -1.0, 0.25])
+    samples = analyzer.samples(chunk)
+    assert samples.dtype == np.float64
+    np.testing.assert_array_equal(samples, chunk)
+    # A normalized recording at full scale keeps its loudest negative sample in the buffer
+    data = recording(20)
+    data = data / np.max(np.abs(data))
+    data = data if data.min() == -1 else -data
+    analyzer = stream.StreamingAnalyzer()
+    for k in range(0, data.size, 100):
+        analyzer.push(data[k:k + 100])
+    np.testing.assert_array_equal(analyzer.current_window(), data)
+    assert analyzer.estimate is not None